@@ -0,0 +1,121 @@
+"""
+Allocation of the cycle's mana across all the arbs planned in it.
+
+Each arb is planned on its own, as if it had the whole balance and every market to itself. The allocator then picks how much of each plan to execute, so that together they fit the budget and the holding caps, and arbs that trade on the same market don't both count on that market's prices.
+"""
+
+import logging
+import cvxpy as cp
+import numpy as np
+import solver
+from shares import InfoState, LinkedInfoState, LinkedAnswerState
+from planning import DEFAULT_API_FEE_PER_TRADE, DEFAULT_HOLDING_CAP, per_leg
+
+
+def leg_state(leg):
+    """
+    The market state of a `LegSnapshot`, as `Share.market.current_state()` would give it.
+    """
+    state = InfoState(leg.pool_yes, leg.pool_no, leg.p, leg.order_book)
+    if len(leg.linked_pools) == 0:
+        return state
+    states = {answer_id: InfoState(pool_yes, pool_no, leg.p)
+              for answer_id, pool_yes, pool_no in leg.linked_pools}
+    states[leg.answer_id] = state
+    return LinkedAnswerState(LinkedInfoState(states), leg.answer_id)
+
+
+def estimate(snapshot, plan, true_value=1, api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE):
+    """
+    Estimate the result of executing `plan` on `snapshot`, the same way `Portfolio.exec_arbs` does.
+
+    Returns the total mana spent, the profit, and the shares received of each leg.
+    """
+    shares = [leg_state(leg).shares_received_from_buy(spend, leg.yes) if spend > 0 else 0
+              for leg, spend in zip(snapshot.legs, plan)]
+    copies = min(received / leg.weight for leg,
+                 received in zip(snapshot.legs, shares))
+    spent = sum(plan)
+    return spent, copies * true_value - spent - api_fee_per_trade * len(snapshot), shares
+
+
+def allocate(snapshots, plans, true_values, budget,
+             api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
+             share_holding_cap=DEFAULT_HOLDING_CAP):
+    """
+    Choose the fraction of each plan to execute this cycle, to maximize total profit.
+
+    `plans` has a plan (from `plan_snapshot`) or None for each of `snapshots`. `budget` is the mana available: the balance, plus any loan that will be collected.
+
+    Spend and profit are taken to scale linearly with the fraction executed. Together the chosen fractions
+    - spend at most `budget`,
+    - keep the holdings of every share under `share_holding_cap`, counting the shares of every arb that buys it, and
+    - add up to at most 1 over the arbs trading on any one market, since each was planned against that market's prices as they were before any of the others.
+
+    Returns a list of fractions between 0 and 1, one per snapshot, and a list of the profit each plan is estimated to make if executed in full (0 for those that aren't profitable).
+    """
+    estimates = [estimate(snapshot, plan, true_value, api_fee_per_trade) if plan is not None else None
+                 for snapshot, plan, true_value in zip(snapshots, plans, true_values)]
+    candidates = [k for k, result in enumerate(estimates)
+                  if result is not None and result[0] > 0 and result[1] > 0]
+    fractions = [0.0 for _ in snapshots]
+    estimated_profits = [0.0 for _ in snapshots]
+    for k in candidates:
+        estimated_profits[k] = float(estimates[k][1])
+    if len(candidates) == 0:
+        return fractions, estimated_profits
+
+    spends = np.array([estimates[k][0] for k in candidates])
+    profits = np.array([estimates[k][1] for k in candidates])
+
+    x = cp.Variable(len(candidates))
+    constraints = [x >= 0, x <= 1, spends @ x <= max(budget, 0)]
+
+    # Shares bought of each share, by arb, and the room left under its cap
+    share_rows = {}
+    headroom = {}
+    markets = {}
+    for i, k in enumerate(candidates):
+        caps = per_leg(share_holding_cap, snapshots[k])
+        for j, (leg, received) in enumerate(zip(snapshots[k].legs, estimates[k][2])):
+            share_rows.setdefault(leg.key, np.zeros(len(candidates)))[
+                i] += received
+            if caps is not None:
+                headroom[leg.key] = max(
+                    caps[j] + leg.complimentary_holding - leg.holding, 0)
+            markets.setdefault(leg.market_id, set()).add(i)
+
+    for key, row in share_rows.items():
+        if key in headroom:
+            constraints.append(row @ x <= headroom[key])
+    for arbs in markets.values():
+        if len(arbs) > 1:
+            constraints.append(cp.sum(x[sorted(arbs)]) <= 1)
+
+    problem = cp.Problem(cp.Maximize(profits @ x), constraints)
+    try:
+        solver.solve(problem)
+        chosen = np.clip(x.value, 0, 1)
+    except ValueError as error:
+        logging.warning(
+            f"Failed to allocate, falling back to greedy by ROI: {error}")
+        chosen = greedy(spends, profits, budget,
+                        [set(leg.market_id for leg in snapshots[k].legs) for k in candidates])
+
+    for i, k in enumerate(candidates):
+        fractions[k] = float(chosen[i])
+    return fractions, estimated_profits
+
+
+def greedy(spends, profits, budget, market_ids):
+    """
+    Take whole arbs in order of ROI while they fit the budget, skipping any on a market already taken.
+    """
+    chosen = np.zeros(len(spends))
+    taken = set()
+    for i in np.argsort(-profits / spends):
+        if spends[i] <= budget and len(market_ids[i] & taken) == 0:
+            chosen[i] = 1
+            budget -= spends[i]
+            taken |= market_ids[i]
+    return chosen
@@ -1,8 +1,11 @@
 """
 Functions for access to the manifold API.
 """
+import math
+import threading
 import time
 import requests
+import metrics
 from constants import API_KEY
 
 
@@ -11,6 +14,53 @@ BET_RATE_LIMIT = 6  # seconds
 BOT_USERNAME = "JointBot"
 BOT_ID = "dTaXWSfwgkSAJDDlzmIGrEQIl2X2"
 
+# Read requests may be made from several threads, so they share one schedule
+_read_lock = threading.Lock()
+_next_read_time = 0
+
+
+def wait_for_read_slot():
+    """
+    Sleep until READ_REQUEST_RATE_LIMIT has passed since the last read request from any thread.
+    """
+    global _next_read_time
+    with _read_lock:
+        now = time.monotonic()
+        wait = max(_next_read_time - now, 0)
+        _next_read_time = now + wait + READ_REQUEST_RATE_LIMIT
+    time.sleep(wait)
+    metrics.observe("rate_limit_wait_seconds", wait, kind="read")
+
+
+def wait_for_bet_slot():
+    """
+    Sleep for BET_RATE_LIMIT before a request that bets or otherwise writes.
+    """
+    time.sleep(BET_RATE_LIMIT)
+    metrics.observe("rate_limit_wait_seconds", BET_RATE_LIMIT, kind="bet")
+
+
+def http_get(endpoint, url, **kwargs):
+    """
+    requests.get, counting and timing the request under `endpoint`, the path of the url without its parameters.
+    """
+    with metrics.timer("http_request_seconds", method="GET", endpoint=endpoint):
+        response = requests.get(url, **kwargs)
+    metrics.increment("http_requests", method="GET", endpoint=endpoint,
+                      status=response.status_code)
+    return response
+
+
+def http_post(endpoint, url, **kwargs):
+    """
+    requests.post, counting and timing the request like `http_get`.
+    """
+    with metrics.timer("http_request_seconds", method="POST", endpoint=endpoint):
+        response = requests.post(url, **kwargs)
+    metrics.increment("http_requests", method="POST", endpoint=endpoint,
+                      status=response.status_code)
+    return response
+
 
 def get_balance():
     """
@@ -19,8 +69,8 @@ def get_balance():
 
     url_query = f"https://api.manifold.markets/v0/user/{BOT_USERNAME}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/user", url_query, timeout=10)
 
     if response.status_code != 200:
         print("Error fetching user data")
@@ -39,8 +89,8 @@ def get_data_from_slug(slug):
 
     url_query = f"https://api.manifold.markets/v0/slug/{slug}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/slug", url_query, timeout=10)
 
     if response.status_code != 200:
         print(f"Error fetching for market {slug}")
@@ -59,8 +109,8 @@ def get_data_from_marketID(marketId):
 
     url_query = f"https://api.manifold.markets/v0/market/{marketId}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/market", url_query, timeout=10)
 
     if response.status_code != 200:
         print(f"Error fetching for market {marketId}")
@@ -70,15 +120,19 @@ def get_data_from_marketID(marketId):
     return response.json()
 
 
-def get_markets():
+def get_markets(limit=1000, before=None):
     """
-    Get all the markets.
+    Get a page of markets, newest first.
+
+    `before` is the id of a market, to get the page of markets created before it.
     """
 
-    url_query = "https://api.manifold.markets/v0/markets"
+    url_query = f"https://api.manifold.markets/v0/markets?limit={limit}"
+    if before is not None:
+        url_query += f"&before={before}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/markets", url_query, timeout=10)
 
     if response.status_code != 200:
         print("Error fetching for markets")
@@ -88,29 +142,62 @@ def get_markets():
     return response.json()
 
 
-def post_order_binary(market_id, mana_amount, outcome, end_prob):
+def get_all_markets():
+    """
+    Get every market, by paging through get_markets.
+    """
+
+    markets = []
+    before = None
+    while True:
+        page = get_markets(before=before)
+        markets.extend(page)
+        if len(page) == 0:
+            return markets
+        before = page[-1]["id"]
+
+
+def rounded_limit_prob(prob, outcome):
+    """
+    Round `prob` to the whole percent that limit orders need, towards the side that lets an order for `outcome` fill at `prob`.
+    """
+    if outcome == "YES":
+        limit_prob = math.ceil(round(prob * 100, 6)) / 100
+    else:
+        limit_prob = math.floor(round(prob * 100, 6)) / 100
+    return min(max(limit_prob, 0.01), 0.99)
+
+
+def post_order_binary(market_id, mana_amount, outcome, limit_prob, expiration_delta=60*1000):
     """
-    Post an order to the market with the given id.
+    Post a limit order to the market with the given id.
+
+    The order fills until the probability reaches `limit_prob`, and whatever hasn't filled is cancelled after `expiration_delta` milliseconds.
 
     See https://docs.manifold.markets/api#post-v0bet for API docs.
+
+    Returns the bet the order made, or None if it failed.
     """
 
     print(
-        f"Posting order for market {market_id}, for {mana_amount} mana to outcome {outcome}, with end prob {end_prob}")
+        f"Posting order for market {market_id}, for {mana_amount} mana to outcome {outcome}, with limit prob {limit_prob}")
 
     # From mqp "yeah you need to specify also an answerId"
 
     assert (outcome in ["YES", "NO"])
 
     # Sleep for a time per request of API
-    time.sleep(BET_RATE_LIMIT)
-    response = requests.post(
+    wait_for_bet_slot()
+    response = http_post(
+        "/v0/bet",
         "https://api.manifold.markets/v0/bet",
         json={
             # This can't be a float, even though the backend supports floats
             "amount": int(mana_amount),
             "outcome": outcome,
-            "contractId": market_id
+            "contractId": market_id,
+            "limitProb": rounded_limit_prob(limit_prob, outcome),
+            "expiresAt": int(time.time() * 1000) + expiration_delta
         },
         headers={
             "Content-Type": "application/json",
@@ -122,23 +209,25 @@ def post_order_binary(market_id, mana_amount, outcome, end_prob):
     if response.status_code != 200:
         print(f"Error posting order for market {market_id}")
         print(response.text)
-        return False
+        return None
 
-    if abs(response.json()["probAfter"] - end_prob) > 0.001:
+    if abs(response.json()["probAfter"] - limit_prob) > 0.001:
         print(f"Weird order for market {market_id}")
         print(
-            f"Expected final prob {end_prob} but got {response.json()['probAfter']}")
+            f"Expected final prob {limit_prob} but got {response.json()['probAfter']}")
         print(response.text)
-        return True
+        return response.json()
 
     print("Success")
 
-    return True
+    return response.json()
 
 
-def post_order_independent_multi(market_id, answer_id, mana_amount, outcome, limit_prob):
+def post_order_independent_multi(market_id, answer_id, mana_amount, outcome, limit_prob, expiration_delta=60*1000):
     """
-    Post an order to the multimarket market with the given id.
+    Post a limit order to the multimarket market with the given id, like `post_order_binary`.
+
+    Returns the bet the order made, or None if it failed.
     """
 
     print(
@@ -147,15 +236,18 @@ def post_order_independent_multi(market_id, answer_id, mana_amount, outcome, lim
     assert (outcome in ["YES", "NO"])
 
     # Sleep for a time per request of API
-    time.sleep(BET_RATE_LIMIT)
-    response = requests.post(
+    wait_for_bet_slot()
+    response = http_post(
+        "/v0/bet",
         "https://api.manifold.markets/v0/bet",
         json={
             # I think this can be a float if desired
             "amount": int(mana_amount),
             "outcome": outcome,
             "contractId": market_id,
-            "answerId": answer_id
+            "answerId": answer_id,
+            "limitProb": rounded_limit_prob(limit_prob, outcome),
+            "expiresAt": int(time.time() * 1000) + expiration_delta
         },
         headers={
             "Content-Type": "application/json",
@@ -167,28 +259,152 @@ def post_order_independent_multi(market_id, answer_id, mana_amount, outcome, lim
     if response.status_code != 200:
         print(f"Error posting order for market {market_id}")
         print(response.text)
-        return False
+        return None
 
     print("Success")
     # print(response.text)
-    return True
+    return response.json()
 
 
-def get_bets_of_user(username):
+def cancel_bet(bet_id):
+    """
+    Cancel what hasn't filled of the limit order with the given bet id.
+
+    See https://docs.manifold.markets/api#post-v0betcancelid for API docs.
+
+    Returns the cancelled bet, with the amount and shares of everything that filled before it was cancelled, or None if it failed.
+    """
+
+    print(f"Cancelling order {bet_id}")
 
-    url_query = f"https://api.manifold.markets/v0/bets?username={username}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_bet_slot()
+    response = http_post(
+        "/v0/bet/cancel",
+        f"https://api.manifold.markets/v0/bet/cancel/{bet_id}",
+        headers={
+            "Authorization": f"Key {API_KEY}"
+        },
+        timeout=10
+    )
 
     if response.status_code != 200:
-        print(f"Error fetching bets of user {username}")
+        print(f"Error cancelling order {bet_id}")
         print(response.text)
-        return []
+        return None
 
     return response.json()
 
 
+def sell_shares(market_id, outcome, shares, answer_id=None):
+    """
+    Sell `shares` of our `outcome` shares of the market with the given id, or of one of its answers.
+
+    See https://docs.manifold.markets/api#post-v0marketmarketidsell for API docs.
+
+    Returns the bet the sale made, whose amount is minus the mana received, or None if it failed.
+    """
+
+    print(
+        f"Selling {shares} {outcome} shares of market {market_id} {answer_id or ''}")
+
+    assert (outcome in ["YES", "NO"])
+
+    body = {
+        "outcome": outcome,
+        "shares": shares
+    }
+    if answer_id is not None:
+        body["answerId"] = answer_id
+
+    # Sleep for a time per request of API
+    wait_for_bet_slot()
+    response = http_post(
+        "/v0/market/sell",
+        f"https://api.manifold.markets/v0/market/{market_id}/sell",
+        json=body,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Key {API_KEY}"
+        },
+        timeout=10
+    )
+
+    if response.status_code != 200:
+        print(f"Error selling shares of market {market_id}")
+        print(response.text)
+        return None
+
+    print("Success")
+    return response.json()
+
+
+def get_bets(username=None, contract_id=None, contract_slug=None, before=None, limit=1000, kinds=None):
+    """
+    Get a page of bets, newest first, optionally only those of one user or market.
+
+    `before` is the id of a bet, to get the page of bets made before it.
+    `kinds` of "open-limit" gets only limit orders that are still open.
+
+    Returns None if the request failed, so that it isn't mistaken for the end of the bets.
+    """
+
+    url_query = f"https://api.manifold.markets/v0/bets?limit={limit}"
+    if username is not None:
+        url_query += f"&username={username}"
+    if contract_id is not None:
+        url_query += f"&contractId={contract_id}"
+    if contract_slug is not None:
+        url_query += f"&contractSlug={contract_slug}"
+    if before is not None:
+        url_query += f"&before={before}"
+    if kinds is not None:
+        url_query += f"&kinds={kinds}"
+    # Sleep for a time per request of API
+    wait_for_read_slot()
+    response = http_get("/v0/bets", url_query, timeout=10)
+
+    if response.status_code != 200:
+        print(f"Error fetching bets with {url_query}")
+        print(response.text)
+        return None
+
+    return response.json()
+
+
+def get_bets_of_user(username):
+    """
+    Get all the bets of a user, newest first, by paging through get_bets.
+
+    Raises ValueError if a page couldn't be fetched, rather than returning a history with its older bets missing.
+    """
+
+    bets = []
+    before = None
+    while True:
+        page = get_bets(username=username, before=before)
+        if page is None:
+            raise ValueError(f"Failed to fetch the bets of {username} before {before}")
+        if len(page) == 0:
+            return bets
+        bets.extend(page)
+        before = page[-1]["id"]
+
+
+def get_open_limit_orders(contract_id):
+    """
+    Get the limit orders on a market that can still be filled, or None if they couldn't be fetched.
+    """
+
+    orders = get_bets(contract_id=contract_id, kinds="open-limit")
+    if orders is None:
+        return None
+    now = time.time() * 1000
+    return [order for order in orders
+            if not order.get("isFilled", False) and not order.get("isCancelled", False)
+            and order.get("expiresAt", now + 1) > now]
+
+
 def get_positions(marketId):
     """
     Get all the positions of everyone in some market
@@ -196,8 +412,8 @@ def get_positions(marketId):
 
     url_query = f"https://api.manifold.markets/v0/market/{marketId}/positions"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/market/positions", url_query, timeout=10)
 
     if response.status_code != 200:
         print("Error fetching positions")
@@ -214,8 +430,8 @@ def get_position_for_user(marketId, userId):
 
     url_query = f"https://api.manifold.markets/v0/market/{marketId}/positions?userId={userId}"
     # Sleep for a time per request of API
-    time.sleep(READ_REQUEST_RATE_LIMIT)
-    response = requests.get(url_query, timeout=10)
+    wait_for_read_slot()
+    response = http_get("/v0/market/positions", url_query, timeout=10)
 
     if response.status_code != 200:
         print("Error fetching positions")
@@ -226,12 +442,15 @@ def get_position_for_user(marketId, userId):
 
 
 def request_loan():
+    """
+    Collect the daily loan. Returns the response, with the mana received as "payout", or [] on failure.
+    """
 
     url_query = "https://api.manifold.markets/request-loan"
     # Sleep for a time per request of API
-    time.sleep(BET_RATE_LIMIT)
-    response = requests.get(
-        url_query,
+    wait_for_bet_slot()
+    response = http_get(
+        "/request-loan", url_query,
         headers={
             "Authorization": f"Key {API_KEY}"
         },
@@ -244,6 +463,3 @@ def request_loan():
         return []
 
     return response.json()
-
-
-print(request_loan())
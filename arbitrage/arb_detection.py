@@ -1,6 +1,7 @@
 
-import spacy
-from api import get_data_from_marketID, get_bets_of_user
+from ingestion import INGESTION_WORKERS, fetch_markets
+from bet_store import BetStore
+from embeddings import EmbeddingStore, load_nlp
 import json
 import time
 
@@ -77,43 +78,73 @@ BOT_USERNAMES = [
     'JointBot',
 ]
 
-nlp = spacy.load("en_core_web_md")
+SIMILARITY_THRESHOLD = 0.90
 
-output = []
+nlp = load_nlp()
+store = EmbeddingStore(nlp)
+bet_store = BetStore()
+
+# Pairs of markets bet on by the same bot within 10 seconds
+candidate_id_pairs = []
+
+print(f"Getting new bets for {len(BOT_USERNAMES)} users")
+bet_store.sync([{"username": username} for username in BOT_USERNAMES],
+               max_workers=INGESTION_WORKERS)
 
 for username in BOT_USERNAMES:
 
-    print(f"Getting bets for {username}")
-    user_bets = get_bets_of_user(username)
+    # (created time, contract id) of each bet, oldest first
+    sorted_bets = bet_store.iterate(
+        "created_time, contract_id", username=username).fetchall()
+
+    for (time1, id1), (time2, id2) in zip(sorted_bets, sorted_bets[1:]):
+        if abs(time1 - time2) < 10000 and id1 != id2:
+            candidate_id_pairs.append((id1, id2))
 
-    sorted_bets = sorted(user_bets, key=lambda bet: bet["createdTime"])
+# Get each market once, however many pairs it is in
+candidate_id_pairs = list(set(candidate_id_pairs))
+market_data = fetch_markets(
+    [market_id for pair in candidate_id_pairs for market_id in pair])
+print(
+    f"Found {len(candidate_id_pairs)} pairs of markets in {len(market_data)} markets")
 
-    for bet1, bet2 in zip(sorted_bets, sorted_bets[1:]):
-        if abs(bet1["createdTime"] - bet2["createdTime"]) < 10000 and bet1["contractId"] != bet2["contractId"]:
-            # Get the markets
-            id1 = bet1["contractId"]
-            id2 = bet2["contractId"]
-            market1 = get_data_from_marketID(id1)
-            market2 = get_data_from_marketID(id2)
-            if market1["closeTime"] < time.time() * 1000:
-                continue
-            if market2["closeTime"] < time.time() * 1000:
-                continue
-            question1 = market1["question"]
-            question2 = market2["question"]
+# Pairs of open markets
+candidate_pairs = []
+for id1, id2 in candidate_id_pairs:
+    if id1 not in market_data or id2 not in market_data:
+        continue
+    market1 = market_data[id1]
+    market2 = market_data[id2]
+    if market1["closeTime"] < time.time() * 1000:
+        continue
+    if market2["closeTime"] < time.time() * 1000:
+        continue
+    candidate_pairs.append((market1, market2))
+
+# Embed every question once, in batches, and compare them all with one matrix product
+markets = {market["id"]: market for pair in candidate_pairs for market in pair}
+market_ids = list(markets)
+store.embed(market_ids, [markets[market_id]["question"]
+            for market_id in market_ids])
+similarities = store.vectors_for(market_ids) @ store.vectors_for(market_ids).T
+rows = {market_id: row for row, market_id in enumerate(market_ids)}
+
+output = []
 
-            doc1 = nlp(question1)
-            doc2 = nlp(question2)
-            if doc1.similarity(doc2) > 0.90:
-                print(f"\nMarket 1: {question1}")
-                print(f"Market 2: {question2}")
-                print(f"Similarity: {doc1.similarity(doc2)}")
-                output.append([
-                    question1,
-                    question2,
-                    market1["slug"],
-                    market2["slug"],
-                ])
+for market1, market2 in candidate_pairs:
+    similarity = similarities[rows[market1["id"]], rows[market2["id"]]]
+    if similarity > SIMILARITY_THRESHOLD:
+        question1 = market1["question"]
+        question2 = market2["question"]
+        print(f"\nMarket 1: {question1}")
+        print(f"Market 2: {question2}")
+        print(f"Similarity: {similarity}")
+        output.append([
+            question1,
+            question2,
+            market1["slug"],
+            market2["slug"],
+        ])
 
 # Dump output to json file
 with open("arbs.json", "w") as f:
@@ -7,9 +7,18 @@ It calculates the optimal risk-free profit for a particular arbitrage opportunit
 
 
 from shares import *
-from arb_listing import complimentary_collections
-from api import get_balance, get_position_for_user, BOT_ID
+from arb_listing import complimentary_collections, sum_to_one_slugs
+from api import get_position_for_user, BOT_ID
+from balance import BalanceTracker
+from loans import LoanScheduler
+from journal import DecisionJournal
+from planning import plan_snapshots_parallel, DEFAULT_SPENDING_CAP
+from allocation import allocate
+from recycling import recycle
+from sum_to_one import scan_for_sum_to_one_arbs
+from event_log import configure, log
 import logging
+import metrics
 
 DRY_RUN = False
 DRY_RUN = True
@@ -17,15 +26,13 @@ DRY_RUN = True
 # A maximum number of shares to hold of any one type
 SHARE_HOLDING_LIMIT = 300
 ROI_FLOOR = 0.01
+# Worker processes used to plan arbs, None for one per CPU
+PLANNING_WORKERS = None
 
-logging.basicConfig(format='%(levelname)s:%(asctime)s %(message)s',
-                    filename='bot.log', encoding='utf-8',
-                    level=logging.DEBUG)
+# Levels of particular events. In production, raise "arb.skipped" and "arb.considered" to logging.WARNING to drop the chatter about arbs that aren't made
+LOG_EVENT_LEVELS = {}
 
-
-def log(msg):
-    logging.info(msg)
-    print(msg)
+configure(event_levels=LOG_EVENT_LEVELS)
 
 
 # pos = get_position_for_user("v4uXdQHU0VFksoecHm5C", BOT_ID)
@@ -45,73 +52,207 @@ def log(msg):
 # quit()
 
 
-def sort_and_execute_arbs():
+def get_holdings(portfolio):
+    """
+    Get the bot's holdings of each share in the portfolio, and of its compliment.
+    """
+
+    holdings = {}
+    complimentary_holdings = {}
+
+    for share in portfolio.shares:
+        positions = get_position_for_user(share.market.market_id, BOT_ID)
+        if share.answer_text is not None:
+            # Multi markets have a position for each answer
+            positions = [position for position in positions
+                         if position.get("answerId") == share.market.answer_id]
+        if len(positions) == 0:
+            holdings[share] = 0
+            complimentary_holdings[share] = 0
+            continue
+        assert len(positions) == 1
+        position = positions[0]
+        if position["hasYesShares"]:
+            yes_shares = position["totalShares"]["YES"]
+        else:
+            yes_shares = 0
+
+        if position["hasNoShares"]:
+            no_shares = position["totalShares"]["NO"]
+        else:
+            no_shares = 0
+
+        holdings[share] = yes_shares if share.yes else no_shares
+        complimentary_holdings[share] = no_shares if share.yes else yes_shares
+        # print(position)
+
+    return holdings, complimentary_holdings
+
+
+def sort_and_execute_arbs(balance, loans, journal):
+    """
+    Run one cycle of the bot: plan every arb, allocate the balance between them and execute them.
+
+    `balance` is the `BalanceTracker` kept across cycles, which is fetched every BALANCE_REFRESH_INTERVAL and tracked locally in between.
+    `loans` is the `LoanScheduler` that collects the daily loan.
+    `journal` is the `DecisionJournal` every decision is recorded in.
+    """
 
     log(f"Assessing arbs...")
 
-    starting_balance = get_balance()
+    starting_balance = balance.refresh_if_stale()
+    if starting_balance is None:
+        log("Skipping cycle because the balance couldn't be fetched",
+            event="cycle.skipped", level=logging.WARNING)
+        return
+
+    # Collect the loan before any bets, so that it is in the budget and its request doesn't queue behind them
+    loans.collect(balance=balance)
 
     log(f"Found {len(complimentary_collections)} complimentary collections")
     log("\n")
 
-    for portfolio in complimentary_collections:
-
-        holdings = {}
-        complimentary_holdings = {}
-
-        for share in portfolio.shares:
-            positions = get_position_for_user(share.market.market_id, BOT_ID)
-            if len(positions) == 0:
-                holdings[share] = 0
-                complimentary_holdings[share] = 0
+    # Look for multi markets whose answers don't sum to one
+    with metrics.timer("stage_seconds", stage="screen"):
+        sum_to_one_markets = []
+        for slug in sum_to_one_slugs:
+            market = Market(slug=slug)
+            try:
+                market.fetch()
+            except MarketUnavailableError as error:
+                log("Skipping sum to one market because %s", error,
+                    event="market.unavailable", level=logging.WARNING, slug=slug)
                 continue
-            assert len(positions) == 1
-            position = positions[0]
-            if position["hasYesShares"]:
-                yes_shares = position["totalShares"]["YES"]
-            else:
-                yes_shares = 0
-
-            if position["hasNoShares"]:
-                no_shares = position["totalShares"]["NO"]
+            sum_to_one_markets.append(market)
+        sum_to_one_arbs = scan_for_sum_to_one_arbs(sum_to_one_markets)
+    log("Found %s sum to one arbs", len(sum_to_one_arbs),
+        event="cycle.screened", arbs=len(sum_to_one_arbs))
+
+    # Each candidate is a portfolio and its true value
+    candidates = [(portfolio, 1) for portfolio in complimentary_collections] + \
+        [(portfolio, true_value) for portfolio, true_value, _ in sum_to_one_arbs]
+
+    # Markets we have bet on or sold on this cycle, whose snapshots and plans made before are stale
+    touched_slugs = set()
+
+    # Skip portfolios with markets that have disappeared, rather than failing the whole cycle
+    portfolios = []
+    true_values = []
+    all_holdings = []
+    snapshots = []
+    with metrics.timer("stage_seconds", stage="fetch"):
+        for portfolio, true_value in candidates:
+            try:
+                holdings, complimentary_holdings = get_holdings(portfolio)
+                # Sell hedged copies that the markets now value above their true value, freeing their mana for this cycle's arbs
+                _, sold = recycle(portfolio, holdings, true_value=true_value,
+                                  dry_run=DRY_RUN, balance=balance)
+                touched_slugs.update(sold)
+                snapshot = portfolio.snapshot(holdings=holdings,
+                                              complimentary_holdings=complimentary_holdings)
+            except MarketUnavailableError as error:
+                log("Skipping portfolio because %s", error,
+                    event="market.unavailable", level=logging.WARNING)
+                continue
+            portfolios.append(portfolio)
+            true_values.append(true_value)
+            all_holdings.append((holdings, complimentary_holdings))
+            snapshots.append(snapshot)
+
+    # print(f"holdings: {holdings}")
+    # print(f"complimentary_holdings: {complimentary_holdings}")
+
+    # Plan every portfolio in parallel, then execute one at a time
+    with metrics.timer("stage_seconds", stage="plan"):
+        plans = plan_snapshots_parallel(
+            snapshots, true_values=true_values, max_workers=PLANNING_WORKERS)
+
+    # Split the balance between the plans, and execute the chosen ones most profitable first
+    budget = balance.balance
+    with metrics.timer("stage_seconds", stage="allocate"):
+        fractions, profits = allocate(snapshots, plans, true_values, budget)
+    # By the profit expected from the fraction allocated, so that if the budget runs short it is the least profitable arbs that miss out
+    order = sorted(range(len(portfolios)),
+                   key=lambda k: -profits[k] * fractions[k])
+    decision_ids = [journal.record_decision(snapshot, plan=plan, true_value=true_value, fraction=fraction,
+                                            error="planning failed" if plan is None else None)
+                    for snapshot, plan, true_value, fraction in zip(snapshots, plans, true_values, fractions)]
+    allocated = sum(fraction > 0 for fraction in fractions)
+    log("Allocated mana to %s of %s arbs", allocated, len(portfolios),
+        event="cycle.allocated", allocated=allocated, portfolios=len(portfolios), budget=budget)
+
+    with metrics.timer("stage_seconds", stage="execute"):
+        for k in order:
+            portfolio, true_value, (holdings, complimentary_holdings), plan = \
+                portfolios[k], true_values[k], all_holdings[k], plans[k]
+
+            if plan is None or fractions[k] <= 0:
+                continue
+            if any(share.slug in touched_slugs for share in portfolio.shares):
+                # Plan again against the markets as they are now, spending no more than was allocated
+                arb = None
+                spending_cap = {share: spend * fractions[k]
+                                for share, spend in zip(portfolio.shares, plan)}
             else:
-                no_shares = 0
-
-            holdings[share] = yes_shares if share.yes else no_shares
-            complimentary_holdings[share] = no_shares if share.yes else yes_shares
-            # print(position)
-
-        # print(f"holdings: {holdings}")
-        # print(f"complimentary_holdings: {complimentary_holdings}")
-        portfolio.exec_arbs(dry_run=DRY_RUN, holdings=holdings,
-                            complimentary_holdings=complimentary_holdings)
-
-    log(f"starting balance {starting_balance} to ending balance {get_balance()}")
-
-
-log("Starting scheduled arb execution bot")
-
-log("running loop")
-while True:
-    log("running sort_and_execute_arbs")
-    sort_and_execute_arbs()
-    quit()
-    time.sleep(1 * 60)
-    log("1")
-    time.sleep(1 * 60)
-    log("2")
-    time.sleep(1 * 60)
-    log("3")
-    time.sleep(1 * 60)
-    log("4")
-    time.sleep(1 * 60)
-    log("5")
-    time.sleep(1 * 60)
-    log("6")
-    time.sleep(1 * 60)
-    log("7")
-    time.sleep(1 * 60)
-    log("8")
-    time.sleep(1 * 60)
-    log("9")
-    time.sleep(1 * 60)
+                arb = {share: spend * fractions[k]
+                       for share, spend in zip(portfolio.shares, plan)}
+                spending_cap = DEFAULT_SPENDING_CAP
+
+            try:
+                spent = portfolio.exec_arbs(dry_run=DRY_RUN, true_value=true_value, holdings=holdings,
+                                            complimentary_holdings=complimentary_holdings,
+                                            share_spending_cap=spending_cap,
+                                            arb=arb, budget=budget, balance=balance,
+                                            journal=journal, decision_id=decision_ids[k])
+            except MarketUnavailableError as error:
+                log("Skipping portfolio because %s", error,
+                    event="market.unavailable", level=logging.WARNING)
+                continue
+            if spent:
+                budget -= spent
+                touched_slugs.update(share.slug for share in portfolio.shares)
+
+    for problem in resolutions.problems:
+        log("Market problem: %s", problem,
+            event="market.problem", level=logging.WARNING)
+    resolutions.problems.clear()
+
+    log("starting balance %s to expected ending balance %s", starting_balance, balance.balance,
+        event="cycle.finished", starting_balance=starting_balance, ending_balance=balance.balance)
+
+
+# Planning workers may import this module, so only run the bot when executed as a script
+if __name__ == "__main__":
+    log("Starting scheduled arb execution bot")
+    metrics.serve()
+    # Made here rather than on import, so that planning workers importing this module don't make their own
+    balance = BalanceTracker()
+    loans = LoanScheduler()
+    journal = DecisionJournal()
+
+    log("running loop")
+    while True:
+        log("running sort_and_execute_arbs")
+        with metrics.timer("stage_seconds", stage="cycle"):
+            sort_and_execute_arbs(balance, loans, journal)
+        metrics.write_summary()
+        quit()
+        time.sleep(1 * 60)
+        log("1")
+        time.sleep(1 * 60)
+        log("2")
+        time.sleep(1 * 60)
+        log("3")
+        time.sleep(1 * 60)
+        log("4")
+        time.sleep(1 * 60)
+        log("5")
+        time.sleep(1 * 60)
+        log("6")
+        time.sleep(1 * 60)
+        log("7")
+        time.sleep(1 * 60)
+        log("8")
+        time.sleep(1 * 60)
+        log("9")
+        time.sleep(1 * 60)
@@ -213,6 +213,16 @@ fungible_collections = [
 fungible_collections.extend(ascending_bitcoin_high_collections)
 
 
+# Independent multi markets whose answers are mutually exclusive and exhaustive (check for an "Other" answer), so their probabilities should sum to one
+# These are scanned for arbs by sum_to_one.py
+sum_to_one_slugs = [
+    "which-party-will-win-the-2024-us-pr-f4158bf9278a",
+    "who-will-win-the-2024-us-presidenti-8c1c8b2f8964",
+    "who-will-win-the-2024-republican-pr-e1332cf40e59",
+    "who-will-win-the-2024-democratic-pr-47576e90fa38",
+]
+
+
 # Collections of markets that sum to at least 1
 complimentary_collections = [
     [
@@ -0,0 +1,79 @@
+"""
+The bot's balance, tracked locally between fetches.
+
+The balance is only fetched from the API every so often. In between, it is kept up to date from the bets our own orders make and the mana returned when shares we buy recombine with ones we hold, so that the expected balance is known without a request.
+Each fetch measures how far the local balance has drifted from the real one, which is larger than rounding only if something else is moving our mana.
+"""
+
+import logging
+import time
+from collections import deque, namedtuple
+from api import get_balance
+from planning import DEFAULT_API_FEE_PER_TRADE
+
+# Seconds between fetches of the balance
+BALANCE_REFRESH_INTERVAL = 10 * 60
+# Drift in mana beyond which a warning is logged
+BALANCE_DRIFT_TOLERANCE = 5
+
+# The difference between the fetched and the locally tracked balance, at one fetch
+BalanceDrift = namedtuple("BalanceDrift", ["time", "expected", "actual"])
+
+
+class BalanceTracker:
+    """
+    The expected balance of the bot's account.
+    """
+
+    def __init__(self, refresh_interval=BALANCE_REFRESH_INTERVAL,
+                 drift_tolerance=BALANCE_DRIFT_TOLERANCE,
+                 api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE):
+        self.refresh_interval = refresh_interval
+        self.drift_tolerance = drift_tolerance
+        self.api_fee_per_trade = api_fee_per_trade
+        self.balance = None
+        self.last_refresh = None
+        self.drifts = deque(maxlen=100)
+
+    def refresh(self):
+        """
+        Fetch the balance, and record and warn about any drift from the local balance.
+
+        Keeps the local balance if the fetch fails.
+        """
+        actual = get_balance()
+        if not isinstance(actual, (int, float)):
+            logging.warning(
+                "Failed to fetch balance, keeping the local balance")
+            return self.balance
+
+        if self.balance is not None:
+            drift = BalanceDrift(time.time(), self.balance, actual)
+            self.drifts.append(drift)
+            if abs(actual - self.balance) > self.drift_tolerance:
+                logging.warning(
+                    f"Balance drifted by {actual - self.balance:.2f}: expected {self.balance:.2f} but have {actual:.2f}")
+
+        self.balance = actual
+        self.last_refresh = time.monotonic()
+        return self.balance
+
+    def refresh_if_stale(self):
+        """
+        Fetch the balance if it hasn't been fetched within the refresh interval. Returns the expected balance.
+        """
+        if self.last_refresh is None or time.monotonic() - self.last_refresh > self.refresh_interval:
+            return self.refresh()
+        return self.balance
+
+    def debit(self, amount):
+        self.balance -= amount
+
+    def credit(self, amount):
+        self.balance += amount
+
+    def record_bet(self, bet):
+        """
+        Debit the mana spent by `bet`, the response to one of our orders, and its API fee.
+        """
+        self.debit(bet["amount"] + self.api_fee_per_trade)
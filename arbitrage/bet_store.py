@@ -0,0 +1,248 @@
+"""
+A local SQLite store of bets, kept up to date incrementally.
+
+Each sync of a user's or market's bets pages back through the API from the newest bet with the `before` cursor, and stops as soon as it reaches bets already stored, so re-running an analysis only transfers the bets made since the last run.
+
+Each page is stored as it arrives, together with how far back the sync has got, so memory use doesn't grow with the number of bets and a sync that is interrupted resumes where it stopped.
+"""
+
+import json
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from api import get_bets
+
+BET_STORE_PATH = "bets.sqlite"
+# The most fetched pages waiting to be stored
+MAX_QUEUED_PAGES = 16
+# How often, in seconds, a fetching thread waiting on a full queue checks whether the sync has stopped
+PUT_INTERVAL = 0.1
+
+# The filters bets can be synced and read by, and the column each filters on
+QUERY_COLUMNS = {
+    "username": "username",
+    "contract_id": "contract_id",
+    "contract_slug": "contract_slug",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bets (
+    id TEXT PRIMARY KEY,
+    contract_id TEXT NOT NULL,
+    contract_slug TEXT,
+    answer_id TEXT,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    created_time INTEGER NOT NULL,
+    outcome TEXT,
+    amount REAL,
+    shares REAL,
+    prob_before REAL,
+    prob_after REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bets_by_contract ON bets (contract_id, created_time);
+CREATE INDEX IF NOT EXISTS bets_by_contract_slug ON bets (contract_slug, created_time);
+CREATE INDEX IF NOT EXISTS bets_by_user ON bets (user_id, created_time);
+CREATE INDEX IF NOT EXISTS bets_by_username ON bets (username, created_time);
+CREATE INDEX IF NOT EXISTS bets_by_time ON bets (created_time);
+CREATE TABLE IF NOT EXISTS cursors (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    newest_time INTEGER NOT NULL,
+    walk_before TEXT,
+    walk_newest_time INTEGER,
+    PRIMARY KEY (field, value)
+);
+"""
+
+# Columns added to the cursors table since it was first made
+CURSOR_MIGRATIONS = {
+    "walk_before": "ALTER TABLE cursors ADD COLUMN walk_before TEXT",
+    "walk_newest_time": "ALTER TABLE cursors ADD COLUMN walk_newest_time INTEGER",
+}
+
+
+def fetch_new_pages(newest_time, before=None, **query):
+    """
+    Yield the pages of bets matching `query` made at or after `newest_time` (milliseconds), newest first, starting from the bet before the one with id `before`.
+
+    Each page is a (bets, id of the oldest bet on it, whether it is the last page) triple. A page that couldn't be fetched is yielded as None, and ends the walk, as the bets before it are then unknown.
+
+    Only uses the API, so can be run from any thread.
+    """
+    while True:
+        page = get_bets(before=before, **query)
+        if page is None:
+            yield None
+            return
+        last = len(page) == 0 or page[-1]["createdTime"] < newest_time
+        if len(page) > 0:
+            before = page[-1]["id"]
+        yield ([bet for bet in page if bet["createdTime"] >= newest_time], before, last)
+        if last:
+            return
+
+
+class BetStore:
+    """
+    Bets by contract, user and time, synced from the API.
+    """
+
+    def __init__(self, path=BET_STORE_PATH):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        columns = {row[1] for row in self.connection.execute(
+            "PRAGMA table_info(cursors)")}
+        with self.connection:
+            for column, statement in CURSOR_MIGRATIONS.items():
+                if column not in columns:
+                    self.connection.execute(statement)
+
+    def cursor(self, field, value):
+        """
+        The sync state of bets with `field` equal to `value`: the time of the newest bet stored by the last complete sync (-1 if there has been none), and the id of the oldest bet and time of the newest bet stored by an unfinished one (None if there is none).
+        """
+        row = self.connection.execute(
+            "SELECT newest_time, walk_before, walk_newest_time FROM cursors WHERE field = ? AND value = ?",
+            (field, value)).fetchone()
+        return (-1, None, None) if row is None else row
+
+    def newest_time(self, field, value):
+        """
+        The time of the newest bet stored by the last complete sync of bets with `field` equal to `value`, or -1 if there has been none.
+        """
+        return self.cursor(field, value)[0]
+
+    def sync(self, queries, max_workers=1):
+        """
+        Fetch and store the new bets for each of `queries`, each a dict with one of the keys of QUERY_COLUMNS, or empty for the bets of every user on every market.
+
+        The bets are fetched from `max_workers` threads, and stored from this one a page at a time.
+        Bets at the newest stored time are fetched again, so that limit orders that have filled since are updated.
+        A sync that was interrupted, or hit a page that couldn't be fetched, carries on from the oldest bet it stored. The newest time of its query only moves once it has reached the bets stored before it.
+        """
+        cursors = []
+        for query in queries:
+            assert len(query) <= 1 and set(query) <= set(QUERY_COLUMNS)
+            # The cursor of the unfiltered stream of bets is stored under an empty field
+            ((field, value),) = query.items() if query else (("", ""),)
+            cursors.append((query, field, value, *self.cursor(field, value)))
+
+        pages = queue.Queue(maxsize=MAX_QUEUED_PAGES)
+        stopped = threading.Event()
+
+        def put(item):
+            # Gives up once the sync has stopped, rather than waiting forever on a queue no one will read
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=PUT_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walk(k):
+            query, _, _, newest_time, walk_before, _ = cursors[k]
+            try:
+                for page in fetch_new_pages(newest_time, walk_before, **query):
+                    if not put((k, page)):
+                        return
+            finally:
+                put((k, False))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(walk, k) for k in range(len(cursors))]
+            # The newest bet stored by each walk so far
+            walk_newest_times = [cursor[5] if cursor[4] is not None else -1
+                                 for cursor in cursors]
+            running = len(cursors)
+            try:
+                while running > 0:
+                    k, page = pages.get()
+                    query, field, value, newest_time, _, _ = cursors[k]
+                    if page is False:
+                        running -= 1
+                        continue
+                    if page is None:
+                        # The walk so far is kept, so the next sync carries on from its oldest bet
+                        logging.warning(
+                            f"Failed to sync bets of {query or 'all users'}")
+                        continue
+
+                    bets, walk_before, last = page
+                    walk_newest_times[k] = max([walk_newest_times[k]] +
+                                               [bet["createdTime"] for bet in bets])
+                    with self.connection:
+                        self.insert_rows(bets, **query)
+                        if last:
+                            state = (max(newest_time, walk_newest_times[k]), None, None)
+                        else:
+                            state = (newest_time, walk_before, walk_newest_times[k])
+                        self.connection.execute(
+                            "INSERT OR REPLACE INTO cursors (field, value, newest_time, walk_before, walk_newest_time) VALUES (?, ?, ?, ?, ?)",
+                            (field, value, *state))
+            finally:
+                # If storing a page failed or was interrupted, the fetching threads stop, so that the executor can shut down
+                stopped.set()
+
+            for future in futures:
+                future.result()
+
+    def insert(self, bets, username=None, contract_id=None, contract_slug=None):
+        """
+        Store `bets`, replacing any stored bets with the same ids.
+
+        The query the bets were fetched with fills in the username or slug, which bets themselves may not include.
+        """
+        with self.connection:
+            self.insert_rows(bets, username, contract_id, contract_slug)
+
+    def insert_rows(self, bets, username=None, contract_id=None, contract_slug=None):
+        """
+        `insert` within the current transaction.
+        """
+        self.connection.executemany(
+            """
+            INSERT OR REPLACE INTO bets
+            (id, contract_id, contract_slug, answer_id, user_id, username, created_time,
+             outcome, amount, shares, prob_before, prob_after, data)
+            VALUES (?, ?,
+                    COALESCE(?, (SELECT contract_slug FROM bets WHERE id = ?)),
+                    ?, ?,
+                    COALESCE(?, (SELECT username FROM bets WHERE id = ?)),
+                    ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(bet["id"], bet["contractId"],
+              contract_slug or bet.get("contractSlug"), bet["id"],
+              bet.get("answerId"), bet["userId"],
+              username or bet.get("userUsername"), bet["id"],
+              bet["createdTime"], bet.get("outcome"), bet.get("amount"), bet.get("shares"),
+              bet.get("probBefore"), bet.get("probAfter"), json.dumps(bet))
+             for bet in bets])
+
+    def bets(self, after_time=None, **query):
+        """
+        Return the stored bets matching `query` (at most one of the keys of QUERY_COLUMNS), oldest first.
+
+        With `after_time`, only bets made after that time (milliseconds) are returned.
+        """
+        return [json.loads(data) for (data,) in self.iterate("data", after_time=after_time, **query)]
+
+    def iterate(self, columns, after_time=None, **query):
+        """
+        Iterate over tuples of `columns` (an SQL column list) of the stored bets matching `query`, oldest first, without loading them all into memory.
+        """
+        conditions = []
+        parameters = []
+        for field, value in query.items():
+            conditions.append(f"{QUERY_COLUMNS[field]} = ?")
+            parameters.append(value)
+        if after_time is not None:
+            conditions.append("created_time > ?")
+            parameters.append(after_time)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.connection.execute(
+            f"SELECT {columns} FROM bets {where} ORDER BY created_time", parameters)
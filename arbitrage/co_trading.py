@@ -0,0 +1,196 @@
+"""
+Find pairs of markets that the same user trades on together, across every user's bets.
+
+Run this as a script. It streams every bet in the bet store in time order, keeps a sliding window of each user's recent bets, and counts each pair of different markets bet on within the window. Counts are kept approximately with the space-saving algorithm, so memory stays bounded however many bets and pairs there are.
+
+Pairs are then ranked by how unlikely their count would be if users picked the two markets of a pair independently, and the most significant are written to a json file, as candidates for arbs that bots already know about.
+"""
+
+import heapq
+import json
+from collections import deque
+import numpy as np
+import scipy.stats
+from bet_store import BetStore
+from ingestion import INGESTION_WORKERS, fetch_markets
+
+WINDOW_MS = 10000
+# The most bets of one user kept in a window, so that a burst of bets can't blow up the number of pairs
+MAX_WINDOW_BETS = 32
+# The number of pairs and markets whose counts are kept
+PAIR_CAPACITY = 200000
+MARKET_CAPACITY = 100000
+
+MIN_PAIR_COUNT = 5
+SIGNIFICANCE = 1e-6
+MAX_OUTPUT_PAIRS = 500
+OUTPUT_PATH = "co_trading_pairs.json"
+
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent items of a stream, in memory for at most `capacity` items.
+
+    When a new item arrives and the counter is full, it takes over the counter of the least counted item, inheriting its count as error.
+    Every item counted more than (total / capacity) times is kept, and each kept count is an overestimate by at most its error.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # (count, item) entries, some of them stale, for finding the least counted item
+        self.heap = []
+
+    def add(self, item, count=1):
+        self.total += count
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            smallest, evicted = self.pop_smallest()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[item] = smallest + count
+            self.errors[item] = smallest
+        heapq.heappush(self.heap, (self.counts[item], item))
+
+        # Drop the stale entries once they outnumber the live ones
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def pop_smallest(self):
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == count:
+                return count, item
+
+    def __getitem__(self, item):
+        return self.counts.get(item, 0)
+
+    def guaranteed(self, item):
+        """
+        A lower bound on the true count of `item`.
+        """
+        return self.counts.get(item, 0) - self.errors.get(item, 0)
+
+
+class CoTradingDetector:
+    """
+    Counts of pairs of markets bet on by the same user within `window_ms` of each other.
+
+    Feed it bets in time order with `add`.
+    """
+
+    def __init__(self, window_ms=WINDOW_MS, max_window_bets=MAX_WINDOW_BETS,
+                 pair_capacity=PAIR_CAPACITY, market_capacity=MARKET_CAPACITY):
+        self.window_ms = window_ms
+        self.max_window_bets = max_window_bets
+        self.pairs = SpaceSaving(pair_capacity)
+        self.markets = SpaceSaving(market_capacity)
+        # The (time, market id) of each user's bets within the window of their latest bet
+        self.windows = {}
+        self.latest_time = None
+        self.next_prune_time = None
+
+    def add(self, user_id, market_id, created_time):
+        window = self.windows.get(user_id)
+        if window is None:
+            window = self.windows[user_id] = deque(
+                maxlen=self.max_window_bets)
+        while len(window) > 0 and window[0][0] < created_time - self.window_ms:
+            window.popleft()
+
+        for other_market_id in set(other for _, other in window):
+            if other_market_id != market_id:
+                self.pairs.add(tuple(sorted((market_id, other_market_id))))
+                self.markets.add(market_id)
+                self.markets.add(other_market_id)
+        window.append((created_time, market_id))
+
+        self.latest_time = created_time
+        if self.next_prune_time is None:
+            self.next_prune_time = created_time + self.window_ms
+        if created_time >= self.next_prune_time:
+            self.prune()
+
+    def prune(self):
+        """
+        Forget the windows of users who haven't bet within the window, so that memory is only used for users betting now.
+        """
+        cutoff = self.latest_time - self.window_ms
+        self.windows = {user_id: window for user_id, window in self.windows.items()
+                        if window[-1][0] >= cutoff}
+        self.next_prune_time = self.latest_time + self.window_ms
+
+    def frequent_pairs(self, min_count=MIN_PAIR_COUNT, significance=SIGNIFICANCE):
+        """
+        The pairs bet on together significantly more often than chance, most significant first.
+
+        Under independence, a pair of markets bet on together m_a and m_b times in total is expected to make up m_a * m_b / (2 * total pairs) of the pairs, and the chance of seeing at least its count is Poisson.
+        Counts are the guaranteed lower bounds, so approximation can only make a pair look less significant.
+
+        Returns a list of dicts with the two market ids, the count, the expected count and the log10 p-value.
+        """
+        if self.pairs.total == 0:
+            return []
+        candidates = [(pair, self.pairs.guaranteed(pair)) for pair in self.pairs.counts
+                      if self.pairs.guaranteed(pair) >= min_count]
+        if len(candidates) == 0:
+            return []
+
+        counts = np.array([count for _, count in candidates], dtype=float)
+        # A market's total is at least that of any pair it is in, even if it has been evicted from the market counts
+        market_totals = np.array([[max(self.markets[market_id], count) for market_id in pair]
+                                  for pair, count in candidates], dtype=float)
+        expected = market_totals[:, 0] * \
+            market_totals[:, 1] / (2 * self.pairs.total)
+        log_p_values = scipy.stats.poisson.logsf(
+            counts - 1, expected) / np.log(10)
+
+        output = [{
+            "market_ids": list(pair),
+            "count": int(count),
+            "expected": float(expected[i]),
+            "log10_p_value": float(log_p_values[i]),
+        } for i, (pair, count) in enumerate(candidates) if log_p_values[i] < np.log10(significance)]
+        output.sort(key=lambda pair: pair["log10_p_value"])
+        return output
+
+
+def detect(bet_store, after_time=None, **kwargs):
+    """
+    Run a CoTradingDetector over every stored bet, or every bet after `after_time`.
+    """
+    detector = CoTradingDetector(**kwargs)
+    for user_id, market_id, created_time in bet_store.iterate(
+            "user_id, contract_id, created_time", after_time=after_time):
+        detector.add(user_id, market_id, created_time)
+    return detector
+
+
+if __name__ == "__main__":
+    bet_store = BetStore()
+
+    print("Getting new bets of all users")
+    bet_store.sync([{}])
+
+    detector = detect(bet_store)
+    pairs = detector.frequent_pairs()[:MAX_OUTPUT_PAIRS]
+    print(
+        f"Found {len(pairs)} significant pairs among {detector.pairs.total} pairs of bets")
+
+    market_data = fetch_markets([market_id for pair in pairs for market_id in pair["market_ids"]],
+                                max_workers=INGESTION_WORKERS)
+    for pair in pairs:
+        markets = [market_data.get(market_id, {})
+                   for market_id in pair["market_ids"]]
+        pair["slugs"] = [market.get("slug") for market in markets]
+        pair["questions"] = [market.get("question") for market in markets]
+
+    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+        json.dump(pairs, f, indent=4)
@@ -0,0 +1,157 @@
+"""
+Propose fungible collections and complements from the full market listing.
+
+Run this as a script. It embeds the question of every open binary market (only the new ones, as embeddings are cached), finds pairs of very similar questions with an approximate nearest neighbour index, and writes the proposals, with a confidence for each, to a json file for a human to check before adding them to arb_listing.py.
+"""
+
+import json
+import re
+import time
+import numpy as np
+from api import get_all_markets
+from arb_listing import fungible_collections
+from embeddings import EmbeddingStore, load_nlp
+
+SIMILARITY_THRESHOLD = 0.95
+OUTPUT_PATH = "discovery_candidates.json"
+
+# Words that turn a question into (roughly) its complement
+NEGATIONS = {"not", "no", "never", "n't", "without", "fail", "fails"}
+
+
+class LSHIndex:
+    """
+    An approximate nearest neighbour index for unit vectors, by random hyperplane hashing.
+
+    Vectors whose cosine similarity is high land in the same bucket of at least one of the tables with high probability.
+    """
+
+    def __init__(self, dimension, n_tables=8, n_bits=16, seed=0):
+        rng = np.random.default_rng(seed)
+        self.hyperplanes = rng.standard_normal(
+            (n_tables, dimension, n_bits)).astype(np.float32)
+        self.bit_values = 2 ** np.arange(n_bits)
+
+    def buckets(self, vectors):
+        """
+        Yield the array of row indices of `vectors` in each non-trivial bucket of each table.
+        """
+        for hyperplanes in self.hyperplanes:
+            signatures = (vectors @ hyperplanes > 0) @ self.bit_values
+            order = np.argsort(signatures, kind="stable")
+            boundaries = np.flatnonzero(np.diff(signatures[order])) + 1
+            for bucket in np.split(order, boundaries):
+                if len(bucket) > 1:
+                    yield bucket
+
+
+def similar_pairs(vectors, threshold=SIMILARITY_THRESHOLD, index=None):
+    """
+    Find pairs of rows of `vectors` with cosine similarity at least `threshold`.
+
+    Returns a dict from (i, j), i < j, to similarity.
+    """
+    if index is None:
+        index = LSHIndex(vectors.shape[1])
+
+    pairs = {}
+    for bucket in index.buckets(vectors):
+        similarities = vectors[bucket] @ vectors[bucket].T
+        for a, b in zip(*np.nonzero(np.triu(similarities >= threshold, k=1))):
+            i, j = sorted((int(bucket[a]), int(bucket[b])))
+            pairs[(i, j)] = float(similarities[a, b])
+    return pairs
+
+
+def is_negated(question):
+    words = set(re.findall(r"[a-z']+", question.lower().replace("n't", " n't")))
+    return len(words & NEGATIONS) > 0
+
+
+def group(pairs, n):
+    """
+    Group the indices 0..n-1 into the connected components of the graph with edges `pairs`.
+
+    Returns a list of the components with more than one element.
+    """
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        parent[find(i)] = find(j)
+
+    components = {}
+    for i in set(i for pair in pairs for i in pair):
+        components.setdefault(find(i), []).append(i)
+    return list(components.values())
+
+
+def propose(markets, store, threshold=SIMILARITY_THRESHOLD):
+    """
+    Propose fungible collections and complementary pairs among `markets`.
+
+    Pairs of similar questions where exactly one is negated are proposed as complements, and the rest are grouped into fungible collections.
+    Collections already in arb_listing.py are left out.
+    """
+    store.embed([market["id"] for market in markets],
+                [market["question"] for market in markets])
+    vectors = store.vectors_for([market["id"] for market in markets])
+    pairs = similar_pairs(vectors, threshold)
+
+    known = [set(share.slug for share in collection)
+             for collection in fungible_collections]
+
+    complements = []
+    fungible_pairs = {}
+    for (i, j), similarity in pairs.items():
+        if is_negated(markets[i]["question"]) != is_negated(markets[j]["question"]):
+            complements.append({
+                "confidence": similarity,
+                "slugs": [markets[i]["slug"], markets[j]["slug"]],
+                "questions": [markets[i]["question"], markets[j]["question"]],
+            })
+        else:
+            fungible_pairs[(i, j)] = similarity
+
+    collections = []
+    for component in group(fungible_pairs, len(markets)):
+        slugs = set(markets[i]["slug"] for i in component)
+        if any(slugs <= collection for collection in known):
+            continue
+        # A collection is only as trustworthy as its least similar linked pair
+        confidence = min(similarity for (i, j), similarity in fungible_pairs.items()
+                         if i in component)
+        collections.append({
+            "confidence": confidence,
+            "slugs": [markets[i]["slug"] for i in component],
+            "questions": [markets[i]["question"] for i in component],
+        })
+
+    collections.sort(key=lambda proposal: -proposal["confidence"])
+    complements.sort(key=lambda proposal: -proposal["confidence"])
+    return {"fungible_collections": collections, "complements": complements}
+
+
+if __name__ == "__main__":
+    nlp = load_nlp()
+    store = EmbeddingStore(nlp)
+
+    print("Getting all markets")
+    now = time.time() * 1000
+    open_markets = [market for market in get_all_markets()
+                    if market["outcomeType"] == "BINARY"
+                    and not market["isResolved"]
+                    and market.get("closeTime", now) > now]
+    print(f"Found {len(open_markets)} open binary markets")
+
+    proposals = propose(open_markets, store)
+    print(
+        f"Proposing {len(proposals['fungible_collections'])} fungible collections and {len(proposals['complements'])} complements")
+
+    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+        json.dump(proposals, f, indent=4)
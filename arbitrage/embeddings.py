@@ -0,0 +1,104 @@
+"""
+Cached spaCy embeddings of market questions, keyed by market id.
+
+Questions never change once a market is created, so each market only ever needs to be embedded once. The cache is kept on disk between runs, as a raw float32 array that new embeddings are appended to and that is read back memory-mapped, plus a file of the market id of each row.
+"""
+
+import os
+import numpy as np
+import spacy
+
+EMBEDDINGS_PATH = "embeddings"
+SPACY_MODEL = "en_core_web_md"
+
+# Question vectors are averages of the model's static word vectors, which only need the tokenizer
+UNNEEDED_COMPONENTS = ["tok2vec", "tagger", "parser", "senter",
+                       "attribute_ruler", "lemmatizer", "ner"]
+
+
+def load_nlp():
+    """
+    Load the spaCy model with only what is needed for question vectors.
+    """
+    return spacy.load(SPACY_MODEL, exclude=UNNEEDED_COMPONENTS)
+
+
+class EmbeddingStore:
+    """
+    Unit length embedding vectors of market questions, by market id.
+    """
+
+    def __init__(self, nlp, path=EMBEDDINGS_PATH):
+        self.nlp = nlp
+        self.vectors_path = f"{path}.f32"
+        self.ids_path = f"{path}.ids"
+        self.dimension = nlp.vocab.vectors_length
+
+        self.ids = []
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, encoding="utf-8") as f:
+                self.ids = f.read().split()
+        # The row of each market id in self.vectors
+        self.rows = {market_id: row for row, market_id in enumerate(self.ids)}
+
+        # Drop any rows left by a write that was interrupted before its ids were saved
+        expected_size = len(self.ids) * self.dimension * \
+            np.dtype(np.float32).itemsize
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > expected_size:
+            os.truncate(self.vectors_path, expected_size)
+
+        self.vectors = self.open_vectors()
+
+    def open_vectors(self):
+        """
+        Memory-map the vectors file, which has a row for each id.
+        """
+        if len(self.ids) == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                         shape=(len(self.ids), self.dimension))
+
+    def __contains__(self, market_id):
+        return market_id in self.rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def embed(self, market_ids, questions, batch_size=256):
+        """
+        Embed the questions of any of the markets that aren't embedded yet, and append them to the store.
+        """
+        missing = [(market_id, question) for market_id, question in zip(market_ids, questions)
+                   if market_id not in self.rows]
+        if len(missing) == 0:
+            return
+
+        # Questions can repeat within a batch
+        missing = list(dict(missing).items())
+
+        print(f"Embedding {len(missing)} new questions")
+        new_vectors = np.array([doc.vector for doc in self.nlp.pipe(
+            [question for _, question in missing], batch_size=batch_size)], dtype=np.float32)
+
+        # Normalize so that dot products are cosine similarities. Questions with no known words stay zero.
+        norms = np.linalg.norm(new_vectors, axis=1, keepdims=True)
+        new_vectors = np.divide(new_vectors, norms, out=np.zeros_like(
+            new_vectors), where=norms > 0)
+
+        # Write the vectors before the ids, so that an interrupted write leaves extra rows rather than ids without rows
+        with open(self.vectors_path, "ab") as f:
+            f.write(new_vectors.tobytes())
+        with open(self.ids_path, "a", encoding="utf-8") as f:
+            for market_id, _ in missing:
+                f.write(f"{market_id}\n")
+
+        for market_id, _ in missing:
+            self.rows[market_id] = len(self.ids)
+            self.ids.append(market_id)
+        self.vectors = self.open_vectors()
+
+    def vectors_for(self, market_ids):
+        """
+        Return the embeddings of the given (already embedded) markets, one per row.
+        """
+        return np.asarray(self.vectors[[self.rows[market_id] for market_id in market_ids]])
@@ -0,0 +1,149 @@
+"""
+Structured logging of what the bot does, written off the thread that trades.
+
+Each call to `log` is an event, with a name such as "arb.skipped", a level and any fields that describe it. Events are put on a queue, and a background thread writes them as json lines to the log file, and their messages to the console.
+
+Worker processes forked from the bot send their records back with their results, for the parent to write, rather than writing to the log themselves.
+
+Messages are formatted lazily, %-style, so an event below its level costs no formatting at all. Every event has its own logger under "arbbot.", so the level of one kind of event can be raised to silence it without touching the others.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_PATH = "bot.jsonl"
+LOGGER_PREFIX = "arbbot."
+
+_listener = None
+# In a forked worker process, the records logged since they were last drained, for the parent to write
+_worker_records = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats a record as a json object on one line, with its event name and fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "event": getattr(record, "event", record.name),
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class EventQueueHandler(QueueHandler):
+    """
+    Puts records on the queue with their message and fields made into plain values, so that the writer thread doesn't read objects the trading thread goes on to change.
+    """
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.fields = {name: value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+                         for name, value in getattr(record, "fields", {}).items()}
+        return record
+
+
+def configure(path=LOG_PATH, level=logging.DEBUG, event_levels=None, console=True):
+    """
+    Send all logging through a queue to a background writer of json lines at `path`, and of messages to stdout if `console`.
+
+    `event_levels` is a dict of levels for particular events, such as {"arb.skipped": logging.WARNING} to drop skipped arbs.
+
+    Only the first call sets up the writer. Later calls only change levels.
+    """
+    global _listener
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for event, event_level in (event_levels or {}).items():
+        event_logger(event).setLevel(event_level)
+
+    if _listener is not None:
+        return
+
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(JsonLinesFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(console_handler)
+
+    records = queue.SimpleQueue()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(EventQueueHandler(records))
+
+    _listener = QueueListener(records, *handlers,
+                              respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    os.register_at_fork(after_in_child=_collect_in_child)
+
+
+def _collect_in_child():
+    """
+    Make a forked worker process queue its records to be sent back to the parent, rather than write them itself.
+
+    The child's copy of the parent's queue may hold records the parent's writer has yet to write, so it is dropped, and the writer isn't run in the child.
+    """
+    global _worker_records
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _worker_records = queue.SimpleQueue()
+    root.addHandler(EventQueueHandler(_worker_records))
+
+
+def drain():
+    """
+    In a worker process, return the records logged since the last call, to be passed to `replay` in the parent. Elsewhere, return [].
+    """
+    records = []
+    if _worker_records is not None:
+        while True:
+            try:
+                records.append(_worker_records.get_nowait())
+            except queue.Empty:
+                break
+    return records
+
+
+def replay(records):
+    """
+    Log `records` drained from a worker process as if they had been logged here.
+    """
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+def event_logger(event):
+    return logging.getLogger(LOGGER_PREFIX + event)
+
+
+def enabled(event, level=logging.INFO):
+    """
+    Whether an `event` at `level` would be logged, to skip working out what to log when it wouldn't.
+    """
+    return event_logger(event).isEnabledFor(level)
+
+
+def log(msg, *args, event="message", level=logging.INFO, **fields):
+    """
+    Log `msg` %-formatted with `args`, as an `event` at `level` with `fields`.
+    """
+    logger = event_logger(event)
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args,
+                   extra={"event": event, "fields": fields})
@@ -0,0 +1,23 @@
+"""
+Concurrent fetching of the markets bets were made on.
+
+Requests are made from a pool of threads, and share the read rate limit in api.py.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from api import get_data_from_marketID
+
+INGESTION_WORKERS = 8
+
+
+def fetch_markets(market_ids, max_workers=INGESTION_WORKERS):
+    """
+    Get the data of each of `market_ids`, fetching each market once however often it appears.
+
+    Returns a dict from market id to data. Markets that couldn't be fetched are left out.
+    """
+    market_ids = list(dict.fromkeys(market_ids))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        markets = dict(
+            zip(market_ids, executor.map(get_data_from_marketID, market_ids)))
+    return {market_id: data for market_id, data in markets.items() if data != []}
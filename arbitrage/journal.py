@@ -0,0 +1,307 @@
+"""
+An append-only SQLite journal of every arb decision, for analysis after the fact and for replaying plans.
+
+Each decision is a portfolio snapshot with the plan made from it. The orders placed for it, with the bets they made, and its outcome are recorded against it as they happen. Rows are only ever inserted, never updated, so a plan made again against fresher markets before executing is recorded as a new decision that revises the first.
+
+Outcomes are as known when execution finished: the copies of the portfolio completed, and the profit expected from them at the portfolio's true value. Profit realized at resolution isn't recorded.
+
+Writes are queued and made in batches by a background thread with its own connection, so recording a decision costs the trading loop no more than putting it on a queue. Snapshots are pickled and compressed there too.
+"""
+
+import atexit
+import json
+import logging
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+JOURNAL_PATH = "journal.sqlite"
+# The most records written in one transaction
+MAX_BATCH = 1000
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS decisions (
+    id TEXT PRIMARY KEY,
+    time INTEGER NOT NULL,
+    portfolio TEXT NOT NULL,
+    true_value REAL,
+    fraction REAL,
+    status TEXT NOT NULL,
+    error TEXT,
+    plan TEXT,
+    snapshot BLOB NOT NULL,
+    revises TEXT
+);
+CREATE INDEX IF NOT EXISTS decisions_by_time ON decisions (time);
+CREATE TABLE IF NOT EXISTS legs (
+    decision_id TEXT NOT NULL,
+    leg INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    market_id TEXT NOT NULL,
+    answer_id TEXT,
+    slug TEXT,
+    outcome TEXT NOT NULL,
+    weight REAL,
+    prob REAL,
+    holding REAL,
+    planned_spend REAL,
+    PRIMARY KEY (decision_id, leg)
+);
+CREATE INDEX IF NOT EXISTS legs_by_market ON legs (market_id, time);
+CREATE TABLE IF NOT EXISTS orders (
+    decision_id TEXT NOT NULL,
+    leg INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    market_id TEXT NOT NULL,
+    answer_id TEXT,
+    outcome TEXT NOT NULL,
+    amount REAL NOT NULL,
+    limit_prob REAL,
+    expected_shares REAL,
+    bet_id TEXT,
+    spent REAL,
+    shares REAL,
+    is_filled INTEGER,
+    dry_run INTEGER NOT NULL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_by_decision ON orders (decision_id);
+CREATE INDEX IF NOT EXISTS orders_by_market ON orders (market_id, time);
+CREATE TABLE IF NOT EXISTS outcomes (
+    decision_id TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    spent REAL,
+    copies REAL,
+    expected_profit REAL,
+    acquired TEXT
+);
+CREATE INDEX IF NOT EXISTS outcomes_by_decision ON outcomes (decision_id);
+CREATE INDEX IF NOT EXISTS outcomes_by_time ON outcomes (time);
+"""
+
+# Changes to journals made before columns were added or renamed, by table and the column they make
+MIGRATIONS = {
+    ("decisions", "revises"): "ALTER TABLE decisions ADD COLUMN revises TEXT",
+    ("outcomes", "expected_profit"): "ALTER TABLE outcomes RENAME COLUMN profit TO expected_profit",
+}
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def pack_snapshot(snapshot):
+    return zlib.compress(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_snapshot(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+class DecisionJournal:
+    """
+    Records arb decisions to the SQLite database at `path` from a background thread, and queries them.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._read_connection = None
+        # The schema is made before the writer starts, so that queries work straight away
+        connection = sqlite3.connect(path)
+        connection.executescript(SCHEMA)
+        with connection:
+            for (table, column), statement in MIGRATIONS.items():
+                columns = {row[1] for row in connection.execute(
+                    f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    connection.execute(statement)
+        connection.close()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True,
+                                        name="journal")
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record_decision(self, snapshot, plan=None, true_value=1, fraction=None, error=None, revises=None):
+        """
+        Record the plan made from `snapshot` (a `PortfolioSnapshot`), the fraction of it allocated mana, or the error planning it raised.
+
+        `revises` is the id of an earlier decision that this plan replaces, made again because the markets moved before it was executed.
+
+        Returns the id of the decision, to record its orders and outcome against.
+        """
+        decision_id = uuid.uuid4().hex
+        if error is not None:
+            status = "failed"
+        elif revises is not None:
+            status = "revised"
+        elif plan is None or not fraction:
+            status = "unallocated"
+        else:
+            status = "allocated"
+        self._queue.put(("decision", (decision_id, now_ms(), snapshot, plan,
+                                      true_value, fraction, status, error, revises)))
+        return decision_id
+
+    def record_order(self, decision_id, leg, replan_round, market_id, answer_id, outcome, amount,
+                     limit_prob=None, expected_shares=None, bet=None, dry_run=False):
+        """
+        Record an order for `amount` mana on leg number `leg` of a decision, in re-planning round `replan_round`, with the bet it made if it was placed.
+        """
+        self._queue.put(("order", (decision_id, leg, replan_round, now_ms(), market_id, answer_id,
+                                   outcome, amount, limit_prob, expected_shares, bet, dry_run)))
+
+    def record_outcome(self, decision_id, status, spent=0, copies=0, expected_profit=None, acquired=None):
+        """
+        Record how a decision ended: its `status`, the mana spent, the copies of the portfolio completed, the profit they are expected to make at its true value and the shares `acquired` of each leg.
+        """
+        self._queue.put(("outcome", (decision_id, now_ms(), status, spent, copies, expected_profit,
+                                     acquired)))
+
+    def _rows(self, kind, record):
+        """
+        The SQL statements and rows that write a queued record.
+        """
+        if kind == "decision":
+            decision_id, time_ms, snapshot, plan, true_value, fraction, status, error, revises = record
+            yield ("INSERT INTO decisions (id, time, portfolio, true_value, fraction, status, error, plan, snapshot, revises) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (decision_id, time_ms, json.dumps(snapshot.key), true_value, fraction, status,
+                    None if error is None else str(error),
+                    None if plan is None else json.dumps([float(spend) for spend in plan]),
+                    pack_snapshot(snapshot), revises))
+            for i, leg in enumerate(snapshot.legs):
+                yield ("INSERT INTO legs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (decision_id, i, time_ms, leg.market_id, leg.answer_id, leg.slug,
+                        "YES" if leg.yes else "NO", leg.weight, leg.prob, leg.holding,
+                        None if plan is None else float(plan[i])))
+        elif kind == "order":
+            *fields, bet, dry_run = record
+            yield ("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (*fields,
+                    None if not bet else bet.get("betId", bet.get("id")),
+                    None if not bet else bet.get("amount"),
+                    None if not bet else bet.get("shares"),
+                    None if not bet else int(bet.get("isFilled", True)),
+                    int(dry_run),
+                    None if not bet else json.dumps(bet)))
+        elif kind == "outcome":
+            *fields, acquired = record
+            yield ("INSERT INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (*fields, None if acquired is None else json.dumps(acquired)))
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(item is None for item in batch)
+            try:
+                with connection:
+                    for item in batch:
+                        if isinstance(item, tuple):
+                            for sql, row in self._rows(*item):
+                                connection.execute(sql, row)
+            except (sqlite3.Error, TypeError, ValueError):
+                # Losing a batch is better than stopping the writer, and with it every later record
+                logging.exception(f"Failed to write {len(batch)} journal records")
+            # Waiters on a flush are woken once everything queued before it is committed
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if stop:
+                connection.close()
+                return
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything recorded so far is written.
+        """
+        if not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """
+        Write everything recorded and stop the writer.
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _query(self, sql, parameters):
+        if self._read_connection is None:
+            self._read_connection = sqlite3.connect(self.path)
+            self._read_connection.row_factory = sqlite3.Row
+        return [dict(row) for row in self._read_connection.execute(sql, parameters)]
+
+    def decisions(self, market_id=None, after_time=None, before_time=None):
+        """
+        Return the decisions with a leg on the market with id `market_id`, if given, made between `after_time` and `before_time` (milliseconds), oldest first.
+
+        Each is a dict of the columns of the decisions table, with the snapshot unpickled.
+        """
+        conditions = []
+        parameters = []
+        if market_id is not None:
+            conditions.append(
+                "id IN (SELECT decision_id FROM legs WHERE market_id = ?)")
+            parameters.append(market_id)
+        if after_time is not None:
+            conditions.append("time > ?")
+            parameters.append(after_time)
+        if before_time is not None:
+            conditions.append("time < ?")
+            parameters.append(before_time)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        decisions = self._query(
+            f"SELECT * FROM decisions {where} ORDER BY time", parameters)
+        for decision in decisions:
+            decision["snapshot"] = unpack_snapshot(decision["snapshot"])
+            decision["plan"] = None if decision["plan"] is None else json.loads(
+                decision["plan"])
+        return decisions
+
+    def orders(self, decision_id=None, market_id=None, after_time=None):
+        """
+        Return the orders of one decision, or on one market, oldest first.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("decision_id", decision_id), ("market_id", market_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if after_time is not None:
+            conditions.append("time > ?")
+            parameters.append(after_time)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(f"SELECT * FROM orders {where} ORDER BY time", parameters)
+
+    def outcomes(self, decision_id=None, after_time=None):
+        """
+        Return the outcomes of one decision, or of all those recorded after `after_time`, oldest first.
+        """
+        conditions = []
+        parameters = []
+        if decision_id is not None:
+            conditions.append("decision_id = ?")
+            parameters.append(decision_id)
+        if after_time is not None:
+            conditions.append("time > ?")
+            parameters.append(after_time)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(f"SELECT * FROM outcomes {where} ORDER BY time", parameters)
@@ -0,0 +1,94 @@
+"""
+Collection of the daily loan Manifold gives on open positions.
+
+A loan can be collected once a day, with days starting at midnight Pacific time. Pacific time is worked out from the US daylight saving rule rather than the tz database, which needs Python 3.9 and, on some systems, the tzdata package. The day it was last collected is kept on disk, so that restarting the bot doesn't request it again.
+"""
+
+import datetime
+import json
+import logging
+import os
+import time
+from api import request_loan
+
+LOAN_STATE_PATH = "loan_state.json"
+# Seconds to wait before asking again after a failed request
+LOAN_RETRY_INTERVAL = 60 * 60
+
+
+def nth_sunday(year, month, n):
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(days=(6 - first.weekday()) % 7 + 7 * (n - 1))
+
+
+def pacific_date(now=None):
+    """
+    The date in Pacific time at `now` (an aware datetime, default the current time).
+
+    Daylight saving, UTC-7 rather than UTC-8, runs from 2am on the second Sunday of March to 2am on the first Sunday of November.
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    now = now.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    # 2am Pacific standard time, and 2am Pacific daylight time, in UTC
+    dst_start = datetime.datetime.combine(
+        nth_sunday(now.year, 3, 2), datetime.time(10))
+    dst_end = datetime.datetime.combine(
+        nth_sunday(now.year, 11, 1), datetime.time(9))
+    offset = 7 if dst_start <= now < dst_end else 8
+    return (now - datetime.timedelta(hours=offset)).date()
+
+
+class LoanScheduler:
+    """
+    Requests the loan once in each day it is available.
+    """
+
+    def __init__(self, path=LOAN_STATE_PATH):
+        self.path = path
+        self.last_collected = None
+        self.last_attempt = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.last_collected = json.load(f).get("last_collected")
+
+    @staticmethod
+    def today():
+        return pacific_date().isoformat()
+
+    def due(self):
+        """
+        Whether today's loan hasn't been collected, and no request for it has failed recently.
+        """
+        if self.last_collected == self.today():
+            return False
+        return self.last_attempt is None or time.monotonic() - self.last_attempt > LOAN_RETRY_INTERVAL
+
+    def collect(self, balance=None):
+        """
+        Request the loan if it is due, crediting `balance` (a `BalanceTracker`) with it.
+
+        Returns the mana received.
+        """
+        if not self.due():
+            return 0
+
+        self.last_attempt = time.monotonic()
+        response = request_loan()
+        if not isinstance(response, dict):
+            logging.warning(f"Failed to collect loan: {response}")
+            return 0
+
+        payout = response.get("payout", 0)
+        logging.info(f"Collected loan of {payout}")
+        if balance is not None:
+            balance.credit(payout)
+
+        self.last_collected = self.today()
+        self.save()
+        return payout
+
+    def save(self):
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"last_collected": self.last_collected}, f)
+        os.replace(f"{self.path}.tmp", self.path)
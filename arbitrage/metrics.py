@@ -0,0 +1,169 @@
+"""
+Counters and timings of what the bot spends its time on.
+
+Everything is recorded into one registry per process: counters, which only go up, and timings, which keep a count and a total of the seconds observed. Each can have labels, such as the endpoint of an HTTP request or the stage of a cycle.
+The registry is exposed in the Prometheus text format over HTTP, and summarized to a json lines file after each cycle.
+
+Worker processes record into their own registry, which is drained and merged into the parent's after each task.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 9108
+# Only this machine can scrape the metrics unless this is changed, to "" for every interface
+METRICS_HOST = "127.0.0.1"
+METRICS_SUMMARY_PATH = "metrics.jsonl"
+METRIC_PREFIX = "arbbot_"
+
+_lock = threading.Lock()
+# Counter values and timing (count, total seconds) pairs, by name and then by sorted label items
+_counters = {}
+_timings = {}
+
+
+def increment(name, amount=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _counters.setdefault(name, {})
+        values[key] = values.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _timings.setdefault(name, {})
+        count, total = values.get(key, (0, 0.0))
+        values[key] = (count + 1, total + seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Observe the seconds spent in a with block as timing `name`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def drain():
+    """
+    Return everything recorded, and clear it, for merging into another process's registry.
+    """
+    global _counters, _timings
+    with _lock:
+        data = (_counters, _timings)
+        _counters, _timings = {}, {}
+    return data
+
+
+def merge(data):
+    """
+    Add what another process recorded, as returned by its `drain`.
+    """
+    counters, timings = data
+    with _lock:
+        for name, values in counters.items():
+            merged = _counters.setdefault(name, {})
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        for name, values in timings.items():
+            merged = _timings.setdefault(name, {})
+            for key, (count, total) in values.items():
+                old_count, old_total = merged.get(key, (0, 0.0))
+                merged[key] = (old_count + count, old_total + total)
+
+
+def _label_text(key):
+    if len(key) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+               for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def render():
+    """
+    Everything recorded, in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for name, values in sorted(_counters.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+            for key, value in values.items():
+                lines.append(f"{METRIC_PREFIX}{name}{_label_text(key)} {value}")
+        for name, values in sorted(_timings.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} summary")
+            for key, (count, total) in values.items():
+                lines.append(
+                    f"{METRIC_PREFIX}{name}_count{_label_text(key)} {count}")
+                lines.append(
+                    f"{METRIC_PREFIX}{name}_sum{_label_text(key)} {total}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """
+    Everything recorded, as a json-serializable dict. Timings are given with their mean.
+    """
+    def label_name(key):
+        return ",".join(f"{name}={value}" for name, value in key) or "all"
+
+    with _lock:
+        return {
+            "time": time.time(),
+            "counters": {name: {label_name(key): value for key, value in values.items()}
+                         for name, values in _counters.items()},
+            "timings": {name: {label_name(key): {"count": count, "total": total, "mean": total / count}
+                               for key, (count, total) in values.items()}
+                        for name, values in _timings.items()},
+        }
+
+
+def write_summary(path=METRICS_SUMMARY_PATH):
+    """
+    Append the current summary to the json lines file at `path`.
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(summary()) + "\n")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be printed to stderr
+        pass
+
+
+def serve(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Serve the metrics at http://`host`:`port`/metrics from a background thread.
+
+    Returns the server, or None if it couldn't be started, as the bot can run without it.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as error:
+        logging.error(f"Failed to serve metrics on {host}:{port}: {error}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name="metrics").start()
+    return server
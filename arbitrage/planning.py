@@ -0,0 +1,473 @@
+"""
+Planning of arbs from portfolio snapshots.
+
+Nothing here touches the network or the `Market` objects, so that planning can be done in worker processes on `PortfolioSnapshot`s.
+"""
+
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cvxpy as cp
+import numpy as np
+import event_log
+import metrics
+import solver
+
+DEFAULT_HOLDING_CAP = 317
+DEFAULT_SPENDING_CAP = 319
+DEFAULT_API_FEE_PER_TRADE = 0.25
+# The most limit order price levels of each leg that are planned with, cheapest first
+MAX_ORDER_BOOK_LEVELS = 8
+
+# The ArbProgram for each portfolio planned in this process, kept so that the next cycle can warm start from it
+_programs = {}
+
+# Worker processes are started once and reused between cycles
+_executor = None
+
+# The most recent plans, by fingerprint, most recently used last. A plan is a tuple of spends, or the message of the ValueError planning raised.
+PLAN_CACHE_SIZE = 4096
+_plans = OrderedDict()
+
+
+class ArbProgram:
+    """
+    The convex program behind `Portfolio.plan_arbs`, for one portfolio structure.
+
+    Each leg of the portfolio is bought with trades against one or more pools. A share of a binary market or an independent multi market answer is one trade against its own pool. A share of a choose-one multi market answer is, as on Manifold, a trade against its own pool plus a trade for the opposite outcome against the pool of every other answer in the market, for the same number of shares in each.
+
+    Market states, holdings and caps enter as cvxpy Parameters, so that the compiled problem can be re-solved each cycle, warm starting from the previous solution.
+
+    A leg can also be bought from up to `n_levels` levels of open limit orders, each a fixed number of shares at a fixed price. Manifold fills a bet against a level once the pool's price reaches it, which is exactly the cheapest way to get the shares, so the levels enter the program as linear pieces alongside the pool.
+
+    All mana and share amounts are divided by a scale (the geometric mean of the pool sizes) before they reach the solver, so that it works with numbers near 1 regardless of market liquidity.
+    """
+
+    def __init__(self, yes, weights, own_pool, sibling_pools, pool_p,
+                 spending_capped=True, holding_capped=True, n_levels=0):
+        n = len(yes)
+        n_pools = len(pool_p)
+
+        # Each trade is (leg, pool, whether it buys YES)
+        trades = []
+        for leg in range(n):
+            trades.append((leg, own_pool[leg], yes[leg]))
+            for pool in sibling_pools[leg]:
+                trades.append((leg, pool, not yes[leg]))
+        n_trades = len(trades)
+        own_trades = [t for t, trade in enumerate(trades)
+                      if trade[1] == own_pool[trade[0]]]
+        sibling_trades = [t for t, trade in enumerate(trades)
+                          if trade[1] != own_pool[trade[0]]]
+        linked_legs = [leg for leg in range(n) if len(sibling_pools[leg]) > 0]
+
+        # Constant matrices describing which trades go with which pools and legs
+        trade_pool = np.zeros((n_pools, n_trades))
+        yes_trade_pool = np.zeros((n_pools, n_trades))
+        no_trade_pool = np.zeros((n_pools, n_trades))
+        trade_leg = np.zeros((n, n_trades))
+        own_trade_leg = np.zeros((n, n_trades))
+        for t, (leg, pool, buys_yes) in enumerate(trades):
+            trade_pool[pool, t] = 1
+            (yes_trade_pool if buys_yes else no_trade_pool)[pool, t] = 1
+            trade_leg[leg, t] = 1
+            if t in own_trades:
+                own_trade_leg[leg, t] = 1
+
+        self.true_value = cp.Parameter(nonneg=True)
+        # The total api fee for the arb
+        self.fee = cp.Parameter()
+        # For each pool, the YES and NO pool sizes before the arb
+        self.pool_before = cp.Parameter((n_pools, 2), nonneg=True)
+        # For each pool, y^p n^(1-p) before the arb
+        self.invariant = cp.Parameter(n_pools, nonneg=True)
+        self.spending_cap = cp.Parameter(n)
+        # For each share, how many more shares we can acquire before hitting the holding cap
+        self.holding_headroom = cp.Parameter(n)
+        # For each share, how many shares earlier orders of this arb already acquired, when it is re-planned after a partial fill
+        self.acquired = cp.Parameter(n, nonneg=True)
+
+        # For each trade, how much is spent on it and how many shares it takes out of the pool
+        self.trade_mana = cp.Variable(n_trades, name="Mana spent on trade")
+        self.trade_shares = cp.Variable(
+            n_trades, name="Shares received from trade")
+
+        # Spending mana on a trade mints that many YES and NO shares, which go into the pool, and then the shares bought come out of it
+        self.pool_after_yes = self.pool_before[:, 0] + \
+            trade_pool @ self.trade_mana - yes_trade_pool @ self.trade_shares
+        self.pool_after_no = self.pool_before[:, 1] + \
+            trade_pool @ self.trade_mana - no_trade_pool @ self.trade_shares
+
+        # we can't spend negative mana
+        constraints = [self.trade_mana >= 0]
+
+        # The constraint says that the constant function y^p n^(1-p) in the pool does not decrease
+        # cvxpy approximates p by a fraction, so we remember the exact weights it uses to compute the invariant with
+        self.geo_mean_weights = []
+        for pool in range(n_pools):
+            geo_mean = cp.geo_mean(cp.hstack([self.pool_after_yes[pool], self.pool_after_no[pool]]),
+                                   p=[pool_p[pool], 1 - pool_p[pool]])
+            self.geo_mean_weights.append([float(w) for w in geo_mean.w])
+            constraints.append(geo_mean >= self.invariant[pool])
+
+        self.mana_spent = trade_leg @ self.trade_mana
+        self.shares_acquired = own_trade_leg @ self.trade_shares
+
+        if len(linked_legs) > 0:
+            # For each choose-one leg, how many shares are bought from each of the other answers' pools
+            sets = cp.Variable(len(linked_legs), name="Sets bought")
+            set_leg = np.zeros((n, len(linked_legs)))
+            # A set of NO shares of every other answer is worth a YES share of this one plus (number of answers - 2) mana
+            # A set of YES shares of every other answer is worth a NO share of this one
+            redemption = np.zeros(len(linked_legs))
+            for k, leg in enumerate(linked_legs):
+                set_leg[leg, k] = 1
+                if yes[leg]:
+                    redemption[k] = len(sibling_pools[leg]) - 1
+            sibling_trade_set = np.zeros((len(sibling_trades), len(linked_legs)))
+            sibling_trade_selection = np.zeros((len(sibling_trades), n_trades))
+            for row, t in enumerate(sibling_trades):
+                sibling_trade_set[row, linked_legs.index(trades[t][0])] = 1
+                sibling_trade_selection[row, t] = 1
+
+            constraints.append(sets >= 0)
+            constraints.append(sibling_trade_selection @ self.trade_shares ==
+                               sibling_trade_set @ sets)
+            self.mana_spent = self.mana_spent - \
+                set_leg @ cp.multiply(redemption, sets)
+            self.shares_acquired = self.shares_acquired + set_leg @ sets
+
+        self.n_levels = n_levels
+        if n_levels > 0:
+            # For each leg, the price per share and the shares available at each limit order level
+            self.level_price = cp.Parameter((n, n_levels), nonneg=True)
+            self.level_shares = cp.Parameter((n, n_levels), nonneg=True)
+            level_fill = cp.Variable(
+                (n, n_levels), name="Shares filled from limit orders")
+            constraints.append(level_fill >= 0)
+            constraints.append(level_fill <= self.level_shares)
+            self.mana_spent = self.mana_spent + \
+                cp.sum(cp.multiply(self.level_price, level_fill), axis=1)
+            self.shares_acquired = self.shares_acquired + \
+                cp.sum(level_fill, axis=1)
+
+        constraints.append(self.mana_spent >= 0)
+
+        if spending_capped:
+            # We can't spend more than the hard cap on any one share
+            constraints.append(self.mana_spent <= self.spending_cap)
+        if holding_capped:
+            # We can't hold more than the hard cap on any one share
+            constraints.append(self.shares_acquired <= self.holding_headroom)
+
+        # The risk free profit is
+        # the amount of complete complimentary sets of portfolio copies acquired
+        # minus the amount of mana spent
+        # Subtract the trading fees as well
+        copies = cp.min(cp.multiply(self.shares_acquired + self.acquired,
+                                    1 / np.array(weights, dtype=float)))
+        self.profit = self.true_value * copies - \
+            cp.sum(self.mana_spent) - self.fee
+
+        self.constraints = constraints
+        self.problem = cp.Problem(cp.Maximize(self.profit), constraints)
+
+    def solve(self, pools, true_value, fee, spending_cap=None, holding_headroom=None, acquired=None,
+              level_price=None, level_shares=None):
+        """
+        Solve the program for the given (YES, NO) pool sizes, caps, fee, shares already acquired and limit order levels.
+
+        Returns a list of *float* amounts to spend on each share.
+        """
+        pools = np.array(pools, dtype=float)
+        scale = float(np.exp(np.mean(np.log(pools))))
+
+        self.true_value.value = true_value
+        self.fee.value = fee / scale
+        self.pool_before.value = pools / scale
+        self.invariant.value = np.array([
+            pool[0] ** w[0] * pool[1] ** w[1]
+            for pool, w in zip(self.pool_before.value, self.geo_mean_weights)])
+        if spending_cap is not None:
+            self.spending_cap.value = np.array(spending_cap, dtype=float) / scale
+        if holding_headroom is not None:
+            self.holding_headroom.value = np.array(
+                holding_headroom, dtype=float) / scale
+        if acquired is None:
+            acquired = np.zeros(self.acquired.shape)
+        self.acquired.value = np.array(acquired, dtype=float) / scale
+        if self.n_levels > 0:
+            self.level_price.value = np.array(level_price, dtype=float)
+            self.level_shares.value = np.array(
+                level_shares, dtype=float) / scale
+
+        try:
+            solver.solve(self.problem, warm_start=True)
+        except ValueError:
+            for constraint in self.constraints:
+                print(constraint)
+            raise
+
+        if self.profit.value is None:
+            for constraint in self.constraints:
+                print(constraint)
+            raise ValueError(
+                f"Profit is {self.profit.value}, which is not a number")
+
+        assert (np.all(self.pool_after_yes.value >= 0))
+        assert (np.all(self.pool_after_no.value >= 0))
+
+        return [float(spent) * scale for spent in self.mana_spent.value]
+
+
+def pool_layout(snapshot):
+    """
+    Find the distinct pools that the legs of `snapshot` trade against.
+
+    Returns the (market id, answer id) of each pool, its (YES, NO) sizes and p, and for each leg the index of its own pool and the indices of the pools of the other answers it is linked to.
+    """
+    pool_ids = []
+    pools = []
+    pool_p = []
+    index = {}
+
+    def add(pool_id, pool, p):
+        if pool_id not in index:
+            index[pool_id] = len(pool_ids)
+            pool_ids.append(pool_id)
+            pools.append(pool)
+            pool_p.append(p)
+        return index[pool_id]
+
+    own_pool = []
+    sibling_pools = []
+    for leg in snapshot.legs:
+        own_pool.append(add((leg.market_id, leg.answer_id), leg.pool, leg.p))
+        sibling_pools.append(tuple(
+            add((leg.market_id, answer_id), (pool_yes, pool_no), leg.p)
+            for answer_id, pool_yes, pool_no in leg.linked_pools))
+
+    return tuple(pool_ids), tuple(pools), tuple(pool_p), tuple(own_pool), tuple(sibling_pools)
+
+
+def order_book_levels(snapshot, n_levels):
+    """
+    The price per share and shares available of the `n_levels` cheapest limit order levels each leg of `snapshot` can fill against, as two (legs, n_levels) arrays padded with empty levels.
+    """
+    level_price = np.ones((len(snapshot), n_levels))
+    level_shares = np.zeros((len(snapshot), n_levels))
+    for i, leg in enumerate(snapshot.legs):
+        if leg.order_book is None:
+            continue
+        for j, (_, price, shares) in enumerate(leg.order_book.levels(leg.yes, leg.prob)[:n_levels]):
+            level_price[i, j] = price
+            level_shares[i, j] = shares
+    return level_price, level_shares
+
+
+def per_leg(cap, snapshot):
+    """
+    Turn a cap that is a number, a dict from leg keys to numbers, or None, into a tuple with one entry per leg (or None).
+    """
+    if cap is None:
+        return None
+    if isinstance(cap, (int, float)):
+        return tuple(cap for _ in snapshot.legs)
+    return tuple(cap[leg.key] for leg in snapshot.legs)
+
+
+def plan_fingerprint(snapshot, true_value=1,
+                     api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
+                     share_holding_cap=DEFAULT_HOLDING_CAP,
+                     share_spending_cap=DEFAULT_SPENDING_CAP,
+                     acquired=None):
+    """
+    Everything the plan of `snapshot` depends on: its legs (pools, weights and holdings, but not the time), caps, fee, true value and shares already acquired.
+    """
+    return (snapshot.legs, true_value, api_fee_per_trade,
+            per_leg(share_holding_cap, snapshot), per_leg(share_spending_cap, snapshot),
+            per_leg(acquired, snapshot))
+
+
+def cached_plan(fingerprint):
+    """
+    The cached plan for `fingerprint`, or None if there is none. Raises the cached error if planning failed.
+    """
+    if fingerprint not in _plans:
+        metrics.increment("cache_lookups", cache="plan", result="miss")
+        return None
+    metrics.increment("cache_lookups", cache="plan", result="hit")
+    _plans.move_to_end(fingerprint)
+    plan = _plans[fingerprint]
+    if isinstance(plan, str):
+        # A new error each time, as raising the same one again would keep adding to its traceback
+        raise ValueError(plan)
+    return plan
+
+
+def cache_plan(fingerprint, plan):
+    """
+    Cache `plan` (a tuple of spends, or a ValueError) for `fingerprint`, evicting the least recently used plans beyond PLAN_CACHE_SIZE.
+    """
+    if isinstance(plan, ValueError):
+        plan = str(plan)
+    _plans[fingerprint] = plan
+    _plans.move_to_end(fingerprint)
+    while len(_plans) > PLAN_CACHE_SIZE:
+        _plans.popitem(last=False)
+
+
+def plan_snapshot(snapshot, true_value=1,
+                  api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
+                  share_holding_cap=DEFAULT_HOLDING_CAP,
+                  share_spending_cap=DEFAULT_SPENDING_CAP,
+                  acquired=None):
+    """
+    Uses cvxpy to find most profitable arbing of the portfolio in `snapshot`.
+
+    Caps are numbers, dicts keyed by `LegSnapshot.key`, or None for no cap.
+
+    `acquired`, a dict keyed the same way, gives the shares of each leg already bought for this arb by orders that were only partly filled. They count towards the copies of the portfolio that the plan completes.
+
+    Returns a tuple of *float* amounts to spend on each leg of the snapshot.
+
+    Plans are cached by `plan_fingerprint`, so a portfolio whose markets and holdings haven't changed isn't solved again. That includes plans that spend nothing, and failures.
+    """
+    fingerprint = plan_fingerprint(snapshot, true_value, api_fee_per_trade,
+                                   share_holding_cap, share_spending_cap, acquired)
+    plan = cached_plan(fingerprint)
+    if plan is None:
+        try:
+            plan = solve_snapshot(snapshot, true_value, api_fee_per_trade,
+                                  share_holding_cap, share_spending_cap, acquired)
+        except ValueError as error:
+            cache_plan(fingerprint, error)
+            raise
+        cache_plan(fingerprint, plan)
+    return plan
+
+
+def solve_snapshot(snapshot, true_value, api_fee_per_trade, share_holding_cap, share_spending_cap, acquired=None):
+    """
+    Solve the ArbProgram of `snapshot`, without the cache. Takes the same arguments as `plan_snapshot`.
+    """
+    share_holding_cap = per_leg(share_holding_cap, snapshot)
+    share_spending_cap = per_leg(share_spending_cap, snapshot)
+
+    pool_ids, pools, pool_p, own_pool, sibling_pools = pool_layout(snapshot)
+
+    n_levels = min(MAX_ORDER_BOOK_LEVELS, max(
+        len(leg.order_book.levels(leg.yes, leg.prob)) if leg.order_book is not None else 0
+        for leg in snapshot.legs))
+    level_price, level_shares = order_book_levels(snapshot, n_levels)
+
+    key = (snapshot.key,
+           pool_ids,
+           pool_p,
+           tuple(leg.weight for leg in snapshot.legs),
+           share_spending_cap is not None,
+           share_holding_cap is not None,
+           n_levels)
+    if key not in _programs:
+        _programs[key] = ArbProgram(
+            yes=[leg.yes for leg in snapshot.legs],
+            weights=[leg.weight for leg in snapshot.legs],
+            own_pool=own_pool,
+            sibling_pools=sibling_pools,
+            pool_p=pool_p,
+            spending_capped=share_spending_cap is not None,
+            holding_capped=share_holding_cap is not None,
+            n_levels=n_levels)
+
+    if share_holding_cap is not None:
+        # Shares of the compliment are recombined with the ones we buy, so they make room under the cap
+        holding_headroom = [cap + leg.complimentary_holding - leg.holding
+                            for cap, leg in zip(share_holding_cap, snapshot.legs)]
+    else:
+        holding_headroom = None
+
+    return tuple(_programs[key].solve(
+        pools,
+        true_value=true_value,
+        fee=api_fee_per_trade * len(snapshot),
+        spending_cap=share_spending_cap,
+        holding_headroom=holding_headroom,
+        acquired=per_leg(acquired, snapshot),
+        level_price=level_price,
+        level_shares=level_shares))
+
+
+def plan_in_worker(snapshot, **kwargs):
+    """
+    Run `plan_snapshot` in a worker process, returning the plan, or the error it raised, with what the worker recorded in metrics and logged while planning.
+    """
+    try:
+        return plan_snapshot(snapshot, **kwargs), None, metrics.drain(), event_log.drain()
+    except Exception as error:
+        return None, error, metrics.drain(), event_log.drain()
+
+
+def plan_snapshots_parallel(snapshots, true_values=None, max_workers=None, **kwargs):
+    """
+    Plan each of `snapshots` in a pool of worker processes.
+
+    `true_values` gives the true value of each portfolio (default all 1), and any other keyword arguments are passed to `plan_snapshot` for every snapshot.
+
+    Returns a list with the result of `plan_snapshot` for each snapshot, or None where planning failed.
+
+    Each worker keeps its own programs, so a portfolio only warm starts when it lands on a worker that has planned it before.
+    Plans cached in this process are used without sending the snapshot to a worker at all.
+    """
+    global _executor
+
+    if true_values is None:
+        true_values = [1 for _ in snapshots]
+
+    fingerprints = [plan_fingerprint(snapshot, true_value=true_value, **kwargs)
+                    for snapshot, true_value in zip(snapshots, true_values)]
+
+    futures = []
+    for snapshot, true_value, fingerprint in zip(snapshots, true_values, fingerprints):
+        if fingerprint in _plans:
+            futures.append(None)
+            continue
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            futures.append(_executor.submit(
+                plan_in_worker, snapshot, true_value=true_value, **kwargs))
+        except BrokenProcessPool:
+            # A worker died in an earlier cycle, so start a new pool
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+            futures.append(_executor.submit(
+                plan_in_worker, snapshot, true_value=true_value, **kwargs))
+
+    plans = []
+    for snapshot, fingerprint, future in zip(snapshots, fingerprints, futures):
+        try:
+            if future is None:
+                plans.append(cached_plan(fingerprint))
+            else:
+                plan, error, worker_metrics, worker_records = future.result()
+                metrics.merge(worker_metrics)
+                event_log.replay(worker_records)
+                if error is not None:
+                    raise error
+                cache_plan(fingerprint, plan)
+                plans.append(plan)
+        except ValueError as error:
+            if future is not None:
+                cache_plan(fingerprint, error)
+            logging.warning(f"Failed to plan {snapshot.key}: {error}")
+            plans.append(None)
+        except BrokenProcessPool as error:
+            # The other futures of the pool fail the same way, and the next cycle starts a new pool
+            logging.error(f"Planning worker died planning {snapshot.key}: {error}")
+            _executor = None
+            plans.append(None)
+        except Exception as error:
+            # Anything else is a bug in planning this one portfolio, which shouldn't stop the others being traded
+            logging.exception(f"Error planning {snapshot.key}: {error}")
+            plans.append(None)
+    return plans
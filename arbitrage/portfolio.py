@@ -2,24 +2,20 @@
 A module to represent a portfolio of shares.
 """
 
-from shares import Share, InfoState
+from shares import Share, InfoState, LinkedAnswerState
 from api import get_balance
-import cvxpy as cp
+from planning import plan_snapshot, DEFAULT_HOLDING_CAP, DEFAULT_SPENDING_CAP, DEFAULT_API_FEE_PER_TRADE
+from snapshot import LegSnapshot, PortfolioSnapshot
 from collections import Counter
+from event_log import configure, enabled, log
 import logging
+import time
 
-logging.basicConfig(format='%(levelname)s:%(asctime)s %(message)s',
-                    filename='bot.log', encoding='utf-8',
-                    level=logging.DEBUG)
+configure()
 
-DEFAULT_HOLDING_CAP = 317
-DEFAULT_SPENDING_CAP = 319
-DEFAULT_API_FEE_PER_TRADE = 0.25
 
-
-def log(msg):
-    logging.info(msg)
-    print(msg)
+# The most times an arb is re-planned after orders that only partly filled
+MAX_REPLANS = 3
 
 
 class Portfolio():
@@ -66,17 +62,11 @@ class Portfolio():
         for share in self.shares:
             share.refresh()
 
-    def plan_arbs(self, true_value=1,
-                  holdings=None, api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
-                  complimentary_holdings=None,
-                  share_holding_cap=DEFAULT_HOLDING_CAP,
-                  share_spending_cap=DEFAULT_SPENDING_CAP):
+    def snapshot(self, holdings=None, complimentary_holdings=None):
         """
-        Uses cvxpy to find most profitable arbing of portfolio.
+        Capture the state of the portfolio's markets, and our holdings in them, as a `PortfolioSnapshot`.
 
-        Given liquidity constraints of various kinds.
-
-        Returns a dict of *float* amounts to spend on each share in the portfolio.
+        The legs of the snapshot are in the order of `self.shares`.
         """
         # If we're not given holdings, assume we have none
         if holdings is None:
@@ -85,134 +75,112 @@ class Portfolio():
         # If we're not given complimentary holdings, assume we have none
         if complimentary_holdings is None:
             complimentary_holdings = {share: 0 for share in self.shares}
-        # If the share spending cap is a number, turn it into a dict
-        if isinstance(share_holding_cap, (int, float)):
-            share_holding_cap = {
-                share: share_holding_cap for share in self.shares}
-        # If the share purchase individual cap is a number, turn it into a dict
-        if isinstance(share_spending_cap, (int, float)):
-            share_spending_cap = {
-                share: share_spending_cap for share in self.shares}
-
-        # Get the info states of the markets
-        initial_info_states = {share: share.market.current_state()
-                               for share in self.shares}
 
-        # Set up variables for the optimization problem
-
-        # Share weight-in-portfolio constants
-        share_weights = {share: cp.Constant(
-            self.share_counts[share]) for share in self.shares}
-        # A variable for each share representing how much is to be spent on it
-        mana_spent_variables = {share: cp.Variable(
-            name=f"Mana spent on {share}") for share in self.shares}
-        # For each share type, a variable representing how many shares of it are to be purchased
-        share_amount_variables = {share: cp.Variable(
-            name=f"Share acquired of {share}") for share in self.shares}
-        # Make a variable for each share representing how many yes and no shares are to be sent to the pool in the swap
-        sent_in_swap = {share: cp.Variable(
-            shape=(2), name=f"Sent in swap of {share}") for share in self.shares}
-
-        pool_before = {share: cp.Constant(
-            [initial_info_states[share].pool_yes, initial_info_states[share].pool_no]) for share in self.shares
-        }
-
-        pool_after = {share: pool_before[share] +
-                      sent_in_swap[share] for share in self.shares}
-
-        # For each share, introduce a constraint that the amount of mana spent on yields that many shares
-        # The constrain says that the constant function y^p n^(1-p) in the pool
-        purchase_constraints = []
+        legs = []
         for share in self.shares:
-            p = [share.market.p, 1 - share.market.p]
-
-            purchase_constraints.append(
-                cp.geo_mean(pool_after[share], p=p) >= cp.geo_mean(
-                    pool_before[share], p=p)
-            )
-            # we can't spend negative mana
-            purchase_constraints.append(
-                mana_spent_variables[share] >= 0
-            )
-            if share.yes:
-                # The amount of NO shares we send is equal to the money we exchange for shares
-                purchase_constraints.append(
-                    mana_spent_variables[share] == sent_in_swap[share][1]
-                )
-                # The amount of YES shares we receive is equal to the shares we get in the swap, plus those we get in the mana for set of complimentary shares exchange
-                purchase_constraints.append(
-                    share_amount_variables[share] == -
-                    sent_in_swap[share][0] + mana_spent_variables[share]
-                )
-            else:
-                purchase_constraints.append(
-                    mana_spent_variables[share] == sent_in_swap[share][0]
-                )
-                purchase_constraints.append(
-                    share_amount_variables[share] == -
-                    sent_in_swap[share][1] + mana_spent_variables[share]
-                )
-            if share_spending_cap is not None:
-                # We can't spend more than the hard cap on any one share
-                purchase_constraints.append(
-                    mana_spent_variables[share] <= share_spending_cap[share]
-                )
-            if share_holding_cap is not None:
-                # We can't hold more than the hard cap on any one share
-                purchase_constraints.append(
-                    share_amount_variables[share] -
-                    complimentary_holdings[share]
-                    + holdings[share] <= share_holding_cap[share]
-                )
-
-        # The risk free profit is
-        # the amount of complete complimentary sets of portfolio copies acquired
-        # minus the amount of mana spent
-        # Subtract the trading fees as well
-        feeless_profit = true_value * cp.min(cp.hstack([share_amount_variables[share] for share in self.shares]) / cp.hstack(
-            [share_weights[share] for share in self.shares])) - cp.sum([mana_spent_variables[share] for share in self.shares])
-        profit = feeless_profit - api_fee_per_trade * len(self.shares)
-
-        # Optimize for the risk free profit,
-        objective = cp.Maximize(profit)
-        problem = cp.Problem(objective, purchase_constraints)
-        # This solver doesn't fail, others do, don't know why
-        problem.solve(solver=cp.SCS)
-
-        if problem.status != cp.OPTIMAL:
-            for constraint in purchase_constraints:
-                print(constraint)
-            raise ValueError(f"Problem status is {problem.status}")
-
-        profit = profit.value
-        # print(f"PROFIT is {profit} on api fee {api_fee_per_trade} and true value {true_value}")
-
-        if profit is None:
-            for constraint in purchase_constraints:
-                print(constraint)
-            raise ValueError(f"Profit is {profit}, which is not a number")
-
-        mana_spent = {
-            share: mana_spent_variables[share].value for share in self.shares}
+            state = share.market.current_state()
+            legs.append(LegSnapshot(
+                slug=share.slug,
+                answer_text=share.answer_text,
+                market_id=share.market.market_id,
+                answer_id=None if share.answer_text is None else share.market.answer_id,
+                yes=share.yes,
+                weight=self.share_counts[share],
+                pool_yes=state.pool_yes,
+                pool_no=state.pool_no,
+                p=state.p,
+                order_book=None if isinstance(
+                    state, LinkedAnswerState) else state.order_book,
+                holding=holdings[share],
+                complimentary_holding=complimentary_holdings[share],
+                linked_pools=tuple(
+                    (answer_id, other.pool_yes, other.pool_no)
+                    for answer_id, other in state.other_states.items()
+                ) if isinstance(state, LinkedAnswerState) else ()))
+
+        return PortfolioSnapshot(legs, int(time.time() * 1000))
 
-        for share in self.shares:
-            assert (pool_after[share][0].value >= 0)
-            assert (pool_after[share][1].value >= 0)
+    def plan_arbs(self, true_value=1,
+                  holdings=None, api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
+                  complimentary_holdings=None,
+                  share_holding_cap=DEFAULT_HOLDING_CAP,
+                  share_spending_cap=DEFAULT_SPENDING_CAP,
+                  snapshot=None,
+                  acquired=None):
+        """
+        Uses cvxpy to find most profitable arbing of portfolio.
 
-        return mana_spent
+        Given liquidity constraints of various kinds.
+
+        Plans on `snapshot` if given, otherwise on a snapshot of the current market states and `holdings`.
+
+        `acquired` optionally gives the shares of each share already bought for this arb, by orders that were only partly filled.
+
+        Returns a dict of *float* amounts to spend on each share in the portfolio.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot(holdings=holdings,
+                                     complimentary_holdings=complimentary_holdings)
+
+        # If the caps are dicts, key them the way the snapshot does
+        if isinstance(share_holding_cap, dict):
+            share_holding_cap = {share.key: cap for share,
+                                 cap in share_holding_cap.items()}
+        if isinstance(share_spending_cap, dict):
+            share_spending_cap = {share.key: cap for share,
+                                  cap in share_spending_cap.items()}
+        if acquired is not None:
+            acquired = {share.key: amount for share,
+                        amount in acquired.items()}
+
+        plan = plan_snapshot(snapshot, true_value=true_value,
+                             api_fee_per_trade=api_fee_per_trade,
+                             share_holding_cap=share_holding_cap,
+                             share_spending_cap=share_spending_cap,
+                             acquired=acquired)
+
+        return dict(zip(self.shares, plan))
 
     def exec_arbs(self, dry_run=True, true_value=1,
                   api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
                   holdings=None,
                   complimentary_holdings=None,
                   share_holding_cap=DEFAULT_HOLDING_CAP,
-                  share_spending_cap=DEFAULT_SPENDING_CAP):
+                  share_spending_cap=DEFAULT_SPENDING_CAP,
+                  arb=None,
+                  budget=None,
+                  balance=None,
+                  journal=None,
+                  decision_id=None):
         """
         Profitability/liquidity reqs of an arbing of portfolio.
 
         Assuming that the true value of the portfolio is at least `true_value`.
+
+        If `arb` is given, it is used as the plan instead of calling `plan_arbs`.
+        Its profitability is still checked against fresh market states.
+
+        If `budget` is given, the arb is only executed if it spends at most that much, instead of checking the balance.
+        If `balance` (a `BalanceTracker`) is given, its expected balance is checked instead of fetching the balance, and it is updated with the bets made.
+        If `journal` (a `DecisionJournal`) is given, the orders placed and how the arb ended are recorded in it against the decision `decision_id`, or a new decision if that is None. An arb planned here is recorded as a new decision revising `decision_id`.
+
+        Returns the mana spent if the arb was executed.
         """
 
+        def record_outcome(status, acquired=None, spent=None):
+            if journal is None:
+                return
+            if acquired is None:
+                journal.record_outcome(decision_id, status)
+                return
+            copies = min(acquired[share] / self.share_counts[share]
+                         for share in self.shares)
+            journal.record_outcome(
+                decision_id, status, spent=sum(spent.values()), copies=copies,
+                expected_profit=copies * true_value - sum(spent.values()) -
+                api_fee_per_trade * sum(spend > 0 for spend in spent.values()),
+                acquired=[acquired[share] for share in self.shares])
+
         # Refresh the info on all the markets
         self.refresh_all()
 
@@ -224,11 +192,23 @@ class Portfolio():
         if complimentary_holdings is None:
             complimentary_holdings = {share: 0 for share in self.shares}
 
-        arb = self.plan_arbs(true_value=true_value,
-                             api_fee_per_trade=api_fee_per_trade,
-                             holdings=holdings, complimentary_holdings=complimentary_holdings,
-                             share_holding_cap=share_holding_cap,
-                             share_spending_cap=share_spending_cap)
+        if arb is None:
+            snapshot = self.snapshot(holdings=holdings,
+                                     complimentary_holdings=complimentary_holdings)
+            arb = self.plan_arbs(true_value=true_value,
+                                 api_fee_per_trade=api_fee_per_trade,
+                                 share_holding_cap=share_holding_cap,
+                                 share_spending_cap=share_spending_cap,
+                                 snapshot=snapshot)
+            if journal is not None:
+                # This plan, not the one the decision was made with, is what gets executed
+                decision_id = journal.record_decision(snapshot, plan=[arb[share] for share in self.shares],
+                                                      true_value=true_value, revises=decision_id)
+        elif journal is not None and decision_id is None:
+            decision_id = journal.record_decision(self.snapshot(holdings=holdings,
+                                                                complimentary_holdings=complimentary_holdings),
+                                                  plan=[arb[share] for share in self.shares],
+                                                  true_value=true_value)
 
         # log(f"Arb as floats")
         # for share in self.shares:
@@ -260,20 +240,27 @@ class Portfolio():
             total_mana_spent - 0.25 * len(self.shares)
 
         if profit <= 0:
-            log(f"Skipping arb because profit is {profit}")
-            log(f"    Portfolio:")
-            log(f"{self}")
-            log(f"    Arb:")
-            for share in self.shares:
-                log(f"    {share}: {arb[share]}")
-
+            if enabled("arb.skipped", logging.DEBUG):
+                log("Skipping arb because profit is %s\n    Portfolio:\n%s\n    Arb:\n%s",
+                    profit, self, "\n".join(f"    {share}: {arb[share]}" for share in self.shares),
+                    event="arb.skipped", level=logging.DEBUG,
+                    reason="unprofitable", profit=profit)
+            record_outcome("skipped:unprofitable")
             return
 
         # Check that we have enough mana to execute the arb
-        current_balance = get_balance()
+        if budget is not None:
+            current_balance = budget
+        elif balance is not None:
+            current_balance = balance.balance
+        else:
+            current_balance = get_balance()
         if total_mana_spent > current_balance:
-            log(
-                f"Not enough mana to execute arb: {total_mana_spent} mana to be spent, {current_balance} mana in balance")
+            log("Not enough mana to execute arb: %s mana to be spent, %s mana in balance",
+                total_mana_spent, current_balance,
+                event="arb.skipped", level=logging.INFO,
+                reason="balance", spend=total_mana_spent, balance=current_balance)
+            record_outcome("skipped:balance")
             return
 
         shares_recombined = {share: min(
@@ -295,62 +282,230 @@ class Portfolio():
 
         # If we've already touched any of the markets in this collection, skip it
 
-        log(f"\n----------------------------")
+        log("\n----------------------------", event="arb.considered", level=logging.DEBUG)
+
+        # Describing every leg takes a good deal of formatting, so skip it when it wouldn't be logged
+        if enabled("arb.considered", logging.DEBUG):
+            for share in self.shares:
+                if holdings[share] > 0:
+                    held = f"Bot already owns {holdings[share]:.1f} of this share type"
+                elif complimentary_holdings[share] > 0:
+                    held = f"Bot already owns {complimentary_holdings[share]:.1f} of the *complimentary* share type"
+                else:
+                    held = "No preexisting holdings in this market"
+                log("Considering purchase of %s\n    URL: %s\n    %s\n    Suggested spend: %s mana to get %.1f shares\n    From initial prob %.1f%% to final prob %.1f%%",
+                    share, share.market.url, held, arb[share], shares_received[share],
+                    initial_probs[share] * 100, final_probs[share] * 100,
+                    event="arb.considered", level=logging.DEBUG,
+                    share=share, spend=arb[share], shares=shares_received[share],
+                    initial_prob=initial_probs[share], final_prob=final_probs[share])
+                if complimentary_holdings[share] > 0:
+                    log("    We can recombine %s shares", shares_recombined[share],
+                        event="arb.considered", level=logging.DEBUG)
 
-        for share in self.shares:
-            log(f"Considering purchase of {share}")
-            log(f"    URL: {share.market.url}")
-            if holdings[share] > 0:
-                log(
-                    f"    Bot already owns {holdings[share]:.1f} of this share type")
-            elif complimentary_holdings[share] > 0:
-                log(
-                    f"    Bot already owns {complimentary_holdings[share]:.1f} of the *complimentary* share type")
-            else:
-                log(f"    No preexisting holdings in this market")
-            log(
-                f"    Suggested spend: {arb[share]} mana to get {shares_received[share]:.1f} shares")
-            log(
-                f"    From initial prob {initial_probs[share]*100:.1f}% to final prob {final_probs[share]*100:.1f}%")
-            if complimentary_holdings[share] > 0:
-                log(f"    We can recombine {shares_recombined[share]} shares")
-
-        log("")
-        log("Arb summary")
         if balance_decrease > 0:
-            log(f"This arb profits {profit} on a starting capital {total_mana_spent}, decreasing balance by {balance_decrease}, for an ROI of {100*roi:.2f}%")
+            log("Arb summary\nThis arb profits %s on a starting capital %s, decreasing balance by %s, for an ROI of %.2f%%",
+                profit, total_mana_spent, balance_decrease, 100 * roi,
+                event="arb.considered", level=logging.DEBUG,
+                profit=profit, spend=total_mana_spent, balance_decrease=balance_decrease)
         else:
-            log(f"This arb profits {profit} on a starting capital {total_mana_spent}, *increasing* balance by {-balance_decrease}")
+            log("Arb summary\nThis arb profits %s on a starting capital %s, *increasing* balance by %s",
+                profit, total_mana_spent, -balance_decrease,
+                event="arb.considered", level=logging.DEBUG,
+                profit=profit, spend=total_mana_spent, balance_decrease=balance_decrease)
 
         if any(arb[share] < 2 for share in self.shares):
-            log("Not enough mana being spent")
+            log("Not enough mana being spent", event="arb.skipped",
+                level=logging.INFO, reason="too_small")
+            record_outcome("skipped:too_small")
             return
 
         if any(arb[share] > 300 for share in self.shares):
-            log("Too much mana being spent")
+            log("Too much mana being spent", event="arb.aborted",
+                level=logging.ERROR, reason="too_large")
+            record_outcome("aborted:too_large")
             quit()
 
-        log(f"Looks good. Executing arb...")
-        for share in self.shares:
-            log(f"\nOn the market: {share}")
-            log(f"   at {share.market.url}")
-            log(f"   paying {arb[share]:.0f} mana for {shares_received[share]:.2f} shares")
-
-            if not dry_run:
-                success = share.post_order(arb[share], final_probs[share])
-                if not success:
-                    log("Problem with order")
-                    log(f"Aborting")
-                    log("Market data from before post")
-                    log(f"{share.market.api_data_}")
+        log("Looks good. Executing arb...", event="arb.executing",
+            profit=profit, spend=total_mana_spent)
+        # The shares of each leg bought so far, and the mana spent on each
+        acquired = {share: 0 for share in self.shares}
+        spent = {share: 0 for share in self.shares}
+        # The shares of each leg redeemed with its compliment's straight away
+        recombined = {share: 0 for share in self.shares}
+        complimentary_holdings = dict(complimentary_holdings)
+        status = "executed"
+        for replan_round in range(MAX_REPLANS + 1):
+            partly_filled = None
+            for i, share in enumerate(self.shares):
+                if arb[share] < 1:
+                    continue
+                log("\nOn the market: %s\n   at %s\n   paying %.0f mana for %.2f shares",
+                    share, share.market.url, arb[share], shares_received[share],
+                    event="order.placing", share=share, spend=arb[share],
+                    shares=shares_received[share], limit_prob=final_probs[share])
+
+                if dry_run:
+                    acquired[share] += shares_received[share]
+                    spent[share] += arb[share]
+                    if journal is not None:
+                        journal.record_order(decision_id, i, replan_round, **share.order_fields(),
+                                             amount=arb[share], limit_prob=final_probs[share],
+                                             expected_shares=shares_received[share], dry_run=True)
+                    continue
+
+                # A limit at the planned final probability means a front-runner can't make us pay more than planned
+                bet = share.post_order(arb[share], final_probs[share])
+                if bet and not bet.get("isFilled", True):
+                    # Left open, the rest of the order could fill after the re-plan has bought more of this leg
+                    cancelled = share.cancel_order(bet)
+                    if cancelled:
+                        bet = cancelled
+                    else:
+                        log("Failed to cancel the rest of the order on %s, so counting all of it as spent", share,
+                            event="order.cancel_failed", level=logging.ERROR, share=share)
+                        bet = dict(bet, amount=bet.get("orderAmount", arb[share]))
+                if journal is not None:
+                    journal.record_order(decision_id, i, replan_round, **share.order_fields(),
+                                         amount=arb[share], limit_prob=final_probs[share],
+                                         expected_shares=shares_received[share], bet=bet)
+                if not bet:
+                    log("Problem with order\nAborting\nMarket data from before post\n%s",
+                        share.market.api_data_, event="order.failed",
+                        level=logging.ERROR, share=share)
+                    record_outcome("aborted:order_failed", acquired, spent)
                     quit()
 
-                # TODO validate shares received is at least what was calculated
+                acquired[share] += bet["shares"]
+                spent[share] += bet["amount"]
+                # Shares bought alongside the compliment's are redeemed for mana straight away
+                redeemed = min(bet["shares"], complimentary_holdings[share])
+                complimentary_holdings[share] -= redeemed
+                recombined[share] += redeemed
+                if balance is not None:
+                    balance.record_bet(bet)
+                    balance.credit(redeemed)
+                log("Order filled %.2f shares for %.2f mana", bet["shares"], bet["amount"],
+                    event="order.filled", share=share, shares=bet["shares"],
+                    spent=bet["amount"], filled=bet.get("isFilled", True))
+
+                if not bet.get("isFilled", True):
+                    partly_filled = share
+                    break
+
+            if partly_filled is None:
+                break
+            if replan_round == MAX_REPLANS:
+                # A re-plan now would never be executed, and the legs after this one haven't been ordered
+                log("Order on %s only filled %.0f of %s mana, and the arb has been re-planned %s times already, so leaving it partly filled:\n%s",
+                    partly_filled, spent[partly_filled], arb[partly_filled], MAX_REPLANS,
+                    "\n".join(f"    {share}: {acquired[share]:.2f} shares for {spent[share]:.0f} mana"
+                              for share in self.shares),
+                    event="arb.partly_filled", level=logging.WARNING, share=partly_filled)
+                status = "partly_filled"
+                break
+
+            log("Order on %s only filled %.0f of %s mana, so re-planning the rest of the arb",
+                partly_filled, spent[partly_filled], arb[partly_filled],
+                event="arb.replanning", share=partly_filled)
+            replan = self.replan_remaining(acquired, spent, recombined=recombined, true_value=true_value,
+                                           api_fee_per_trade=api_fee_per_trade,
+                                           holdings=holdings, complimentary_holdings=complimentary_holdings,
+                                           share_holding_cap=share_holding_cap,
+                                           share_spending_cap=share_spending_cap,
+                                           budget=current_balance - sum(spent.values()))
+            if replan is None:
+                log("Buying more isn't profitable, so leaving the arb partly filled:\n%s",
+                    "\n".join(f"    {share}: {acquired[share]:.2f} shares for {spent[share]:.0f} mana"
+                              for share in self.shares),
+                    event="arb.partly_filled", level=logging.WARNING)
+                status = "partly_filled"
+                break
+            arb, final_probs, shares_received = replan
+
+            # The same limits as the first plan, on the legs still to be bought
+            if any(arb[share] > 300 for share in self.shares):
+                log("Too much mana being spent", event="arb.aborted",
+                    level=logging.ERROR, reason="too_large")
+                record_outcome("aborted:too_large", acquired, spent)
+                quit()
+            if any(0 < arb[share] < 2 for share in self.shares):
+                log("Not enough mana being spent on the re-planned arb, so leaving it partly filled",
+                    event="arb.partly_filled", level=logging.WARNING, reason="too_small")
+                status = "partly_filled"
+                break
 
         for share in self.shares:
             share.refresh()
 
-        log(f"----------------------------")
+        log("----------------------------", event="arb.executed",
+            spent=sum(spent.values()))
+        record_outcome(status, acquired, spent)
+
+        return sum(spent.values())
+
+    def replan_remaining(self, acquired, spent, recombined=None, true_value=1,
+                         api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE,
+                         holdings=None,
+                         complimentary_holdings=None,
+                         share_holding_cap=DEFAULT_HOLDING_CAP,
+                         share_spending_cap=DEFAULT_SPENDING_CAP,
+                         budget=None):
+        """
+        Plan the rest of an arb whose orders were only partly filled, given the shares `acquired` and mana `spent` on each leg so far, and the shares of each that were `recombined` with `complimentary_holdings` (which are what is left after that).
+
+        Returns the whole amounts to spend on each share, the probability each market should end at and the shares each will give, or None if buying more isn't profitable or doesn't fit in `budget`.
+        """
+        self.refresh_all()
+
+        # The shares already bought count towards the holding caps, and what was spent on them towards the spending caps
+        # Those recombined are no longer held, as they have already been taken off the complimentary holdings
+        if recombined is None:
+            recombined = {share: 0 for share in self.shares}
+        holdings = {share: holdings[share] + acquired[share] - recombined[share]
+                    for share in self.shares}
+        if isinstance(share_spending_cap, dict):
+            share_spending_cap = {share: max(share_spending_cap[share] - spent[share], 0)
+                                  for share in self.shares}
+        elif share_spending_cap is not None:
+            share_spending_cap = {share: max(share_spending_cap - spent[share], 0)
+                                  for share in self.shares}
+
+        try:
+            arb = self.plan_arbs(true_value=true_value,
+                                 api_fee_per_trade=api_fee_per_trade,
+                                 holdings=holdings, complimentary_holdings=complimentary_holdings,
+                                 share_holding_cap=share_holding_cap,
+                                 share_spending_cap=share_spending_cap,
+                                 acquired=acquired)
+        except ValueError as error:
+            log("Failed to re-plan: %s", error, event="arb.replanning",
+                level=logging.WARNING)
+            return None
+        arb = {share: int(arb[share]) for share in self.shares}
+
+        info_states = {share: share.market.current_state()
+                       for share in self.shares}
+        shares_received = {share: info_states[share].shares_received_from_buy(arb[share], share.yes) if arb[share] >= 1 else 0
+                           for share in self.shares}
+
+        # Only the copies completed beyond those already bought count as profit, as the mana already spent is gone either way
+        copies_before = min(
+            acquired[share] / self.share_counts[share] for share in self.shares)
+        copies_after = min((acquired[share] + shares_received[share]) /
+                           self.share_counts[share] for share in self.shares)
+        orders = sum(1 for share in self.shares if arb[share] >= 1)
+        profit = (copies_after - copies_before) * true_value - \
+            sum(arb.values()) - api_fee_per_trade * orders
+
+        if orders == 0 or profit <= 0:
+            return None
+        if budget is not None and sum(arb.values()) > budget:
+            return None
+
+        final_probs = {share: info_states[share].new_state_from_buy(arb[share], share.yes).prob
+                       for share in self.shares}
+        return arb, final_probs, shares_received
 
     # Add portfolios
     def __add__(self, other):
@@ -0,0 +1,112 @@
+"""
+Recycling of the mana locked in hedged positions.
+
+Complete copies of a portfolio we hold are worth its true value at resolution, and until then the mana spent on them is tied up. When the markets have moved so that the copies sell for more than that, selling them is a profit in itself, and frees the mana for this cycle's arbs.
+
+Only whole copies of the portfolios we arb are sold. Holdings that offset each other across different portfolios, or shares left over beyond complete copies, aren't looked for.
+"""
+
+import logging
+import numpy as np
+from event_log import log
+from planning import DEFAULT_API_FEE_PER_TRADE
+
+# The least profit for which a sale is worth making
+MIN_RECYCLE_PROFIT = 1
+# The fractions of the copies held that a sale is priced at
+SALE_FRACTIONS = np.linspace(0.1, 1, 10)
+
+
+def plan_sale(portfolio, holdings, true_value=1, api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE):
+    """
+    Find the most profitable number of copies of `portfolio` to sell out of `holdings`.
+
+    Returns a dict of the shares to sell of each share, the mana the sale receives and its profit over holding the copies to resolution, or None if no sale is profitable enough.
+    """
+    copies_held = min(holdings[share] / portfolio.share_counts[share]
+                      for share in portfolio.shares)
+    if copies_held <= 0:
+        return None
+
+    states = {share: share.market.current_state() for share in portfolio.shares}
+
+    best = (None, 0, -np.inf)
+    for fraction in SALE_FRACTIONS:
+        copies = copies_held * fraction
+        shares = {share: copies * portfolio.share_counts[share]
+                  for share in portfolio.shares}
+        proceeds = sum(states[share].sell(shares[share], share.yes)[1]
+                       for share in portfolio.shares)
+        profit = proceeds - copies * true_value - \
+            api_fee_per_trade * len(portfolio.shares)
+        if profit > best[2]:
+            best = (shares, proceeds, profit)
+
+    if best[2] < MIN_RECYCLE_PROFIT:
+        return None
+    return best
+
+
+def recycle(portfolio, holdings, true_value=1, dry_run=True, balance=None,
+            api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE):
+    """
+    Sell the copies of `portfolio` in `holdings` if that is profitable.
+
+    `holdings` is updated with the shares sold, and `balance` (a `BalanceTracker`) with the mana received.
+
+    Sales can't be given a limit, so before selling each leg the sale is priced again, with the legs already sold at what they got and the rest at their markets' current prices, and selling stops if it is no longer profitable enough.
+
+    Returns the mana received, and the slugs of the markets sold on, whose earlier snapshots are now stale.
+    """
+    sale = plan_sale(portfolio, holdings, true_value, api_fee_per_trade)
+    if sale is None:
+        return 0, set()
+    shares, proceeds, profit = sale
+    first = portfolio.shares[0]
+    copies = shares[first] / portfolio.share_counts[first]
+
+    log("Selling hedged copies of portfolio for %.2f mana, a profit of %.2f:\n%s",
+        proceeds, profit, portfolio, event="recycle.selling",
+        proceeds=proceeds, profit=profit)
+
+    received = 0
+    sold = set()
+    for i, share in enumerate(portfolio.shares):
+        for other in portfolio.shares[i:]:
+            other.refresh()
+        expected = received + sum(other.market.current_state().sell(shares[other], other.yes)[1]
+                                  for other in portfolio.shares[i:])
+        expected_profit = expected - copies * true_value - \
+            api_fee_per_trade * len(portfolio.shares)
+        if expected_profit < MIN_RECYCLE_PROFIT:
+            if i == 0:
+                log("Not selling, as the markets have moved so the sale would only profit %.2f", expected_profit,
+                    event="recycle.skipped", level=logging.INFO, profit=expected_profit)
+                return 0, set()
+            # The legs already sold leave the others unhedged, so stop trading, as when a sale fails
+            log("Markets moved during the sale, so it would only profit %.2f, so stopping with the rest of the portfolio held\n    Holdings now: %s",
+                expected_profit, holdings, event="recycle.failed", level=logging.ERROR,
+                share=share, profit=expected_profit)
+            quit()
+
+        log("    Selling %.2f shares of %s", shares[share], share,
+            event="recycle.selling", share=share, shares=shares[share])
+        if dry_run:
+            received += share.market.current_state().sell(shares[share], share.yes)[1]
+            sold.add(share.slug)
+            continue
+
+        bet = share.sell(shares[share])
+        if not bet:
+            # The legs already sold leave the others unhedged, so stop trading, as exec_arbs does when an order fails, until a human has looked at it
+            log("Problem with sale, so stopping with the rest of the portfolio held\n    Holdings now: %s",
+                holdings, event="recycle.failed", level=logging.ERROR, share=share)
+            quit()
+        received -= bet["amount"]
+        sold.add(share.slug)
+        holdings[share] -= shares[share]
+        if balance is not None:
+            balance.record_bet(bet)
+        share.refresh()
+
+    return received, sold
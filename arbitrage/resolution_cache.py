@@ -0,0 +1,102 @@
+"""
+An on-disk cache of market and answer ids, so that slugs don't need resolving through the API on every run.
+
+Entries are checked lazily: whenever a market is fetched anyway, the ids in the response are compared with the cached ones, and any difference is recorded in `problems` and fixed in the cache.
+"""
+
+import json
+import logging
+import os
+import metrics
+
+CACHE_FILE = "slug_cache.json"
+
+
+class ResolutionCache:
+    """
+    Maps slug to market id, and (slug, answer text) to answer id.
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.market_ids = {}
+        self.answer_ids = {}
+        # Human readable descriptions of renamed, deleted or changed markets found this run
+        self.problems = []
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.market_ids = data["markets"]
+            self.answer_ids = data["answers"]
+
+    def market_id(self, slug):
+        """
+        Return the cached id of the market with `slug`, or None.
+        """
+        market_id = self.market_ids.get(slug)
+        metrics.increment("cache_lookups", cache="market_id",
+                          result="miss" if market_id is None else "hit")
+        return market_id
+
+    def answer_id(self, slug, answer_text):
+        """
+        Return the cached id of the answer `answer_text` in the market with `slug`, or None.
+        """
+        answer_id = self.answer_ids.get(slug, {}).get(answer_text)
+        metrics.increment("cache_lookups", cache="answer_id",
+                          result="miss" if answer_id is None else "hit")
+        return answer_id
+
+    def record_market(self, slug, market_id):
+        """
+        Record that `slug` resolves to `market_id`.
+        """
+        cached = self.market_ids.get(slug)
+        if cached == market_id:
+            return
+        if cached is not None:
+            self.report(
+                f"Slug {slug} now resolves to market {market_id} instead of {cached}")
+            # The answers we knew were for the other market
+            self.answer_ids.pop(slug, None)
+        self.market_ids[slug] = market_id
+        self.save()
+
+    def record_answer(self, slug, answer_text, answer_id):
+        """
+        Record that the answer `answer_text` in the market with `slug` has id `answer_id`.
+        """
+        cached = self.answer_ids.get(slug, {}).get(answer_text)
+        if cached == answer_id:
+            return
+        if cached is not None:
+            self.report(
+                f"Answer {answer_text} of {slug} is now {answer_id} instead of {cached}")
+        self.answer_ids.setdefault(slug, {})[answer_text] = answer_id
+        self.save()
+
+    def forget_answer(self, slug, answer_text):
+        """
+        Remove the answer `answer_text` in the market with `slug` from the cache.
+        """
+        if self.answer_ids.get(slug, {}).pop(answer_text, None) is not None:
+            self.save()
+
+    def report(self, problem):
+        """
+        Record a problem with a cached market, to be reported at the end of the run.
+        """
+        logging.warning(problem)
+        self.problems.append(problem)
+
+    def save(self):
+        """
+        Write the cache to disk.
+        """
+        # Write to a temporary file first, so that a crash can't leave a half written cache
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"markets": self.market_ids,
+                      "answers": self.answer_ids}, f, indent=4)
+        os.replace(temporary_path, self.path)
@@ -1,4 +1,6 @@
-from api import get_data_from_slug, get_data_from_marketID, post_order_binary, post_order_independent_multi
+from api import get_data_from_slug, get_data_from_marketID, get_open_limit_orders, post_order_binary, post_order_independent_multi, sell_shares, cancel_bet
+from resolution_cache import ResolutionCache
+from snapshot import OrderBook
 import cvxpy as cp
 from constants import API_KEY
 import json
@@ -56,6 +58,16 @@ def maniswap_prob_from_pool(pool_yes, pool_no, p):
     return (pool_no * p / (pool_yes * (1-p) + pool_no * p))
 
 
+# The ids of markets and answers we have resolved, kept between runs
+resolutions = ResolutionCache()
+
+
+class MarketUnavailableError(ValueError):
+    """
+    Raised when a market can't be fetched from the API, because it has been deleted or renamed beyond recognition.
+    """
+
+
 class InfoState:
     """
     A class to represent the state of a market/multimarket answer on Manifold.
@@ -64,15 +76,17 @@ class InfoState:
     Amount of mana in the YES pool
     Amount of mana in the NO pool
     p (amm weight parameter)
+    The OrderBook of open limit orders, which bets fill against before the pool (None for none)
     """
 
-    def __init__(self, pool_yes, pool_no, p):
+    def __init__(self, pool_yes, pool_no, p, order_book=None):
         self.pool_yes = pool_yes
         self.pool_no = pool_no
         self.p = p
+        self.order_book = order_book or None
 
     def __str__(self):
-        return f"InfoState(pool_yes={self.pool_yes}, pool_no={self.pool_no}, p={self.p})"
+        return f"InfoState(pool_yes={self.pool_yes}, pool_no={self.pool_no}, p={self.p}, order_book={self.order_book})"
 
     def __repr__(self):
         return str(self)
@@ -80,10 +94,11 @@ class InfoState:
     def __eq__(self, __value: object) -> bool:
         if not isinstance(__value, InfoState):
             return False
-        return self.pool_yes == __value.pool_yes and self.pool_no == __value.pool_no and self.p == __value.p
+        return self.pool_yes == __value.pool_yes and self.pool_no == __value.pool_no and self.p == __value.p \
+            and self.order_book == __value.order_book
 
     def __hash__(self) -> int:
-        return hash((self.pool_yes, self.pool_no, self.p))
+        return hash((self.pool_yes, self.pool_no, self.p, self.order_book))
 
     @property
     def invariant(self):
@@ -93,33 +108,296 @@ class InfoState:
     def prob(self):
         return maniswap_prob_from_pool(self.pool_yes, self.pool_no, self.p)
 
-    def new_state_from_buy(self, amount, yes):
+    def pool_buy(self, amount, yes):
         """
-        Simulates spending amount mana to buy yes (or no) shares.
+        Simulates spending amount mana on the pool alone, ignoring limit orders.
 
-        Returns new InfoState.
+        Returns the new InfoState (with the same order book) and the shares received.
         """
         if yes:
             pool_no = self.pool_no + amount
             pool_yes = (self.invariant / pool_no ** (1 - self.p)) ** (1/self.p)
+            shares = self.pool_yes - pool_yes + amount
         else:
             pool_yes = self.pool_yes + amount
             pool_no = (self.invariant / pool_yes ** self.p) ** (1/(1-self.p))
+            shares = self.pool_no - pool_no + amount
 
-        return InfoState(pool_yes, pool_no, self.p)
+        return InfoState(pool_yes, pool_no, self.p, self.order_book), shares
 
-    def shares_received_from_buy(self, amount, yes):
+    def amount_to_prob(self, prob, yes):
+        """
+        The amount of mana a bet on yes (or no) must spend on the pool to move its probability to `prob`, or 0 if it is already past it.
+        """
+        if yes:
+            # At probability prob, pool_yes = pool_no * p (1 - prob) / ((1 - p) prob), which with the invariant fixes pool_no
+            ratio = self.p * (1 - prob) / ((1 - self.p) * prob)
+            return max(self.invariant / ratio ** self.p - self.pool_no, 0)
+        ratio = (1 - self.p) * prob / (self.p * (1 - prob))
+        return max(self.invariant / ratio ** (1 - self.p) - self.pool_yes, 0)
+
+    def buy(self, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares, as Manifold matches bets.
+
+        The bet moves the pool until its probability reaches the next open limit order, fills against that order while it lasts, and so on until the mana runs out.
+
+        Returns the new InfoState and the shares received.
+        """
+        if self.order_book is None:
+            return self.pool_buy(amount, yes)
+
+        state = self
+        shares = 0
+        fills = {}
+        for q, price, available in self.order_book.levels(yes, self.prob):
+            to_level = state.amount_to_prob(q, yes)
+            if amount <= to_level:
+                break
+            state, pool_shares = state.pool_buy(to_level, yes)
+            amount -= to_level
+            shares += pool_shares
+            fills[q] = min(available, amount / price)
+            shares += fills[q]
+            amount -= fills[q] * price
+            if fills[q] < available:
+                break
+
+        state, pool_shares = state.pool_buy(max(amount, 0), yes)
+        state.order_book = self.order_book.after_fills(yes, fills) or None
+        return state, shares + pool_shares
+
+    def new_state_from_buy(self, amount, yes):
         """
         Simulates spending amount mana to buy yes (or no) shares.
 
         Returns new InfoState.
         """
+        return self.buy(amount, yes)[0]
 
-        new_state = self.new_state_from_buy(amount, yes)
-        if yes:
-            return self.pool_yes - new_state.pool_yes + amount
+    def shares_received_from_buy(self, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares.
+
+        Returns the number of shares received.
+        """
+        return self.buy(amount, yes)[1]
+
+    def amount_for_shares(self, shares, yes):
+        """
+        The amount of mana that must be spent to receive `shares` yes (or no) shares.
+        """
+        if shares <= 0:
+            return 0
+
+        # The shares we receive come out of this side of the pool
+        received, other = (self.pool_yes, self.pool_no) if yes else (
+            self.pool_no, self.pool_yes)
+
+        if self.p == 0.5 and self.order_book is None:
+            # The pool invariant (received + amount - shares) * (other + amount) = received * other is a quadratic in amount
+            b = received + other - shares
+            return (-b + (b ** 2 + 4 * shares * other) ** 0.5) / 2
+
+        return amount_for_shares_by_bisection(self, shares, yes)
+
+    def sell(self, shares, yes):
+        """
+        Simulates selling `shares` yes (or no) shares.
+
+        Manifold sells by buying the same number of the opposite shares, and redeeming each pair for 1 mana.
+        Returns the new InfoState and the mana received.
+        """
+        amount = self.amount_for_shares(shares, not yes)
+        return self.new_state_from_buy(amount, not yes), shares - amount
+
+
+def amount_for_shares_by_bisection(state, shares, yes):
+    """
+    The amount of mana that must be spent to receive `shares` yes (or no) shares from `state`, which can be any state with `shares_received_from_buy`.
+    """
+    if shares <= 0:
+        return 0
+
+    # Each share costs less than 1 mana, so the amount is between 0 and shares
+    low, high = 0, shares
+    for _ in range(100):
+        middle = (low + high) / 2
+        if state.shares_received_from_buy(middle, yes) < shares:
+            low = middle
         else:
-            return self.pool_no - new_state.pool_no + amount
+            high = middle
+    return high
+
+
+class LinkedInfoState:
+    """
+    A class to represent the state of a choose-one (linked) multi market on Manifold.
+
+    Each answer has its own YES/NO pool, but the answers' probabilities are kept summing to one: when someone bets on an answer, Manifold splits the bet between that answer's pool and bets on the opposite outcome of every other answer.
+    A YES bet on an answer buys the same number of NO shares of every other answer, a set of which is worth (number of answers - 2) mana plus a YES share of the answer bet on.
+    A NO bet buys the same number of YES shares of every other answer, a set of which is worth a NO share of the answer bet on.
+    """
+
+    def __init__(self, states):
+        # The InfoState of each unresolved answer, by answer id
+        self.states = dict(states)
+
+    def __str__(self):
+        return f"LinkedInfoState({self.states})"
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, __value: object) -> bool:
+        if not isinstance(__value, LinkedInfoState):
+            return False
+        return self.states == __value.states
+
+    def __hash__(self) -> int:
+        return hash(tuple(sorted(self.states.items())))
+
+    @property
+    def probs(self):
+        return {answer_id: state.prob for answer_id, state in self.states.items()}
+
+    def buy(self, answer_id, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares of an answer.
+
+        Returns the new LinkedInfoState and the number of shares received.
+        """
+        others = [other for other in self.states if other != answer_id]
+
+        def split(set_shares):
+            # The states and shares received if `set_shares` sets of the other answers are bought, and the rest of the mana is spent on the answer itself
+            # None if that costs more than amount
+            states = {}
+            direct = amount
+            for other in others:
+                cost = self.states[other].amount_for_shares(
+                    set_shares, not yes)
+                states[other] = self.states[other].new_state_from_buy(
+                    cost, not yes)
+                direct -= cost
+            if yes:
+                direct += (len(others) - 1) * set_shares
+            if direct < 0:
+                return None
+            states[answer_id] = self.states[answer_id].new_state_from_buy(
+                direct, yes)
+            shares = self.states[answer_id].shares_received_from_buy(
+                direct, yes) + set_shares
+            return LinkedInfoState(states), shares
+
+        def too_few(set_shares):
+            # Whether more sets should be bought to bring the probabilities back to summing to one
+            result = split(set_shares)
+            if result is None:
+                return False
+            total = sum(result[0].probs.values())
+            return total > 1 if yes else total < 1
+
+        if len(others) == 0:
+            return split(0)
+
+        # Double until we have bought too many sets, then bisect
+        low, high = 0, max(amount, 1)
+        while too_few(high):
+            low, high = high, 2 * high
+        for _ in range(100):
+            middle = (low + high) / 2
+            if too_few(middle):
+                low = middle
+            else:
+                high = middle
+        return split(low)
+
+    def new_state_from_buy(self, answer_id, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares of an answer.
+
+        Returns new LinkedInfoState.
+        """
+        return self.buy(answer_id, amount, yes)[0]
+
+    def shares_received_from_buy(self, answer_id, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares of an answer.
+
+        Returns the number of shares received.
+        """
+        return self.buy(answer_id, amount, yes)[1]
+
+
+class LinkedAnswerState:
+    """
+    One answer of a LinkedInfoState, with the same interface as an InfoState.
+    """
+
+    def __init__(self, linked_state, answer_id):
+        self.linked_state = linked_state
+        self.answer_id = answer_id
+
+    def __str__(self):
+        return f"LinkedAnswerState({self.answer_id}, {self.linked_state})"
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def pool_yes(self):
+        return self.linked_state.states[self.answer_id].pool_yes
+
+    @property
+    def pool_no(self):
+        return self.linked_state.states[self.answer_id].pool_no
+
+    @property
+    def p(self):
+        return self.linked_state.states[self.answer_id].p
+
+    @property
+    def prob(self):
+        return self.linked_state.states[self.answer_id].prob
+
+    @property
+    def other_states(self):
+        """
+        The InfoStates of the other unresolved answers of the market, by answer id.
+        """
+        return {answer_id: state for answer_id, state in self.linked_state.states.items() if answer_id != self.answer_id}
+
+    def new_state_from_buy(self, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares.
+
+        Returns new LinkedAnswerState.
+        """
+        return LinkedAnswerState(self.linked_state.new_state_from_buy(self.answer_id, amount, yes), self.answer_id)
+
+    def shares_received_from_buy(self, amount, yes):
+        """
+        Simulates spending amount mana to buy yes (or no) shares.
+
+        Returns the number of shares received.
+        """
+        return self.linked_state.shares_received_from_buy(self.answer_id, amount, yes)
+
+    def amount_for_shares(self, shares, yes):
+        """
+        The amount of mana that must be spent to receive `shares` yes (or no) shares.
+        """
+        return amount_for_shares_by_bisection(self, shares, yes)
+
+    def sell(self, shares, yes):
+        """
+        Simulates selling `shares` yes (or no) shares, as `InfoState.sell` does.
+
+        Returns the new LinkedAnswerState and the mana received.
+        """
+        amount = self.amount_for_shares(shares, not yes)
+        return self.new_state_from_buy(amount, not yes), shares - amount
 
 
 class Market:
@@ -130,15 +408,26 @@ class Market:
     def __init__(self, slug=None, marketId=None):
         self.slug = slug
         self.marketId = marketId
-        # Data to be obtained lazily
-        # self.api_data_ = preloaded_data
+        # Data to be obtained lazily, and kept until the next refresh so that everything read from it is from the same instant
+        self.api_data_ = None
+        # The open limit orders, by answer id (None for a binary market), also obtained lazily
+        self.order_books_ = None
 
     @property
     def data(self):
         """Get the API data for this Market lazily."""
 
+        if self.api_data_ is None:
+            self.fetch()
+        return self.api_data_
+
+    def fetch(self):
+        """Request the market state from the API."""
+
         if self.slug is not None:
             self.api_data_ = get_data_from_slug(self.slug)
+            if self.api_data_ == []:
+                self.api_data_ = self.data_from_cached_id()
         elif self.marketId is not None:
             self.api_data_ = get_data_from_marketID(self.marketId)
         else:
@@ -146,15 +435,67 @@ class Market:
 
         if self.api_data_ == []:
             print(json.dumps(self.api_data_, indent=4))
-            raise ValueError("API data empty")
+            self.api_data_ = None
+            if self.slug is not None:
+                resolutions.report(
+                    f"Market {self.slug} could not be found, it may have been deleted")
+            raise MarketUnavailableError(
+                f"API data empty for market {self.slug or self.marketId}")
+
+        if self.slug is not None:
+            resolutions.record_market(self.slug, self.api_data_["id"])
+        resolutions.record_market(
+            self.api_data_["slug"], self.api_data_["id"])
 
         self.slug = self.api_data_["slug"]
         self.marketId = self.api_data_["id"]
-        return self.api_data_
+
+        # Index the answers of multi markets once per fetch, rather than scanning them on every lookup
+        self.answers_by_text_ = {}
+        self.answers_by_id_ = {}
+        for answer in self.api_data_.get("answers", []):
+            # If two answers have the same text, the first one wins
+            self.answers_by_text_.setdefault(answer["text"], answer)
+            self.answers_by_id_[answer["id"]] = answer
+
+    def data_from_cached_id(self):
+        """
+        Fetch the market by the id we last resolved its slug to, for when the slug no longer works.
+        """
+        market_id = self.marketId or resolutions.market_id(self.slug)
+        if market_id is None:
+            return []
+
+        data = get_data_from_marketID(market_id)
+        if data != []:
+            resolutions.report(
+                f"Market {self.slug} has been renamed to {data['slug']}")
+        return data
+
+    def answer_by_text(self, answer_text):
+        """
+        Return the API data of the answer with `answer_text`, or None if there is none.
+        """
+        if self.api_data_ is None:
+            self.fetch()
+        return self.answers_by_text_.get(answer_text)
+
+    def answer_by_id(self, answer_id):
+        """
+        Return the API data of the answer with `answer_id`, or None if there is none.
+        """
+        if self.api_data_ is None:
+            self.fetch()
+        return self.answers_by_id_.get(answer_id)
 
     @property
     def id(self):
-        return self.data["id"]
+        # Ids never change, so there's no need to fetch the market if we have resolved its slug before
+        if self.marketId is None and self.slug is not None:
+            self.marketId = resolutions.market_id(self.slug)
+        if self.marketId is None:
+            self.marketId = self.data["id"]
+        return self.marketId
 
     @property
     def market_id(self):
@@ -164,7 +505,7 @@ class Market:
         """ Re-request the market state from the API."""
         # TODO clear data from the cache in api.py
         self.api_data_ = None
-        pass
+        self.order_books_ = None
 
     @property
     def creatorId(self):
@@ -226,8 +567,39 @@ class Market:
     def isClosed(self):
         return self.isResolved or self.closeTime < time.time() * 1000
 
+    @property
+    def isLinked(self):
+        """Whether this is a choose-one multi market, whose answers' probabilities sum to one."""
+        return self.data.get("mechanism") == "cpmm-multi-1" and self.data.get("shouldAnswersSumToOne", False)
+
+    def order_book(self, answer_id=None):
+        """
+        The OrderBook of the open limit orders on this market, or on one of its answers, or None if there are none.
+
+        Raises MarketUnavailableError if the orders couldn't be fetched, as pricing against the pool alone would misprice the market.
+        """
+        if self.order_books_ is None:
+            open_orders = get_open_limit_orders(self.id)
+            if open_orders is None:
+                raise MarketUnavailableError(
+                    f"Couldn't fetch the limit orders of market {self.slug or self.id}")
+            orders = {}
+            for order in open_orders:
+                orders.setdefault(order.get("answerId"), []).append(order)
+            self.order_books_ = {order_answer_id: OrderBook.from_orders(answer_orders)
+                                 for order_answer_id, answer_orders in orders.items()}
+        return self.order_books_.get(answer_id) or None
+
     def current_state(self):
-        return InfoState(self.pool_yes, self.pool_no, self.p)
+        return InfoState(self.pool_yes, self.pool_no, self.p, self.order_book())
+
+    def linked_state(self):
+        """The LinkedInfoState of a choose-one multi market, over its unresolved answers."""
+        # Multi market answer pools always have p = 0.5
+        return LinkedInfoState({
+            answer["id"]: InfoState(answer["pool"]["YES"], answer["pool"]["NO"], 0.5)
+            for answer in self.data["answers"] if answer.get("resolution") is None
+        })
 
     def __str__(self):
         return self.question
@@ -242,15 +614,22 @@ class Market:
         # TODO do more validation on the state of the market before and  after the trade, making sure that the api call outpus are consistent with each other and that you get the expected result
         return post_order_binary(self.market_id, mana_amount, outcome, limit_prob, expiration_delta=expiration_delta)
 
+    def sell_order(self, shares, outcome):
+        """
+        Sell shares of the market with the given id.
+        """
+        return sell_shares(self.market_id, outcome, shares)
+
 
 class MultiMarketAnswer:
     """
     A class to represent an answer to a multi market on Manifold.
     """
 
-    def __init__(self, slug, answer_text):
+    def __init__(self, slug, answer_text, market=None):
         self.slug = slug
-        self.market = Market(slug=slug)
+        # Answers of the same market may share a Market, so that it is only fetched once
+        self.market = Market(slug=slug) if market is None else market
         self.answer_text = answer_text
 
     def refresh(self):
@@ -259,16 +638,16 @@ class MultiMarketAnswer:
 
     @property
     def answer_data(self):
-        # Get the first answer from self.market.data["answers"] that matches answer_text
-        answers_texts = [answer["text"]
-                         for answer in self.market.data["answers"]]
-        answers_with_text = [answer["text"]
-                             for answer in self.market.data["answers"] if answer["text"] == self.answer_text]
-        if len(answers_with_text) == 0:
-            print("Found answers", answers_texts)
-            raise ValueError(
+        answer = self.market.answer_by_text(self.answer_text)
+        if answer is None:
+            print("Found answers", list(self.market.answers_by_text_))
+            resolutions.forget_answer(self.slug, self.answer_text)
+            resolutions.report(
+                f"No answer with text {self.answer_text} found in market {self.slug}, it may have been renamed")
+            raise MarketUnavailableError(
                 f"No answer with text {self.answer_text} found in market {self.slug}")
-        return next(answer for answer in self.market.data["answers"] if answer["text"] == self.answer_text)
+        resolutions.record_answer(self.slug, self.answer_text, answer["id"])
+        return answer
 
     @property
     def market_id(self):
@@ -276,6 +655,9 @@ class MultiMarketAnswer:
 
     @property
     def answer_id(self):
+        cached = resolutions.answer_id(self.slug, self.answer_text)
+        if cached is not None:
+            return cached
         return self.answer_data["id"]
 
     @property
@@ -307,7 +689,10 @@ class MultiMarketAnswer:
         return self.market.isClosed
 
     def current_state(self):
-        return InfoState(self.pool_yes, self.pool_no, self.p)
+        # Limit orders on choose-one answers also trade against the other answers, so they aren't modelled
+        if self.market.isLinked:
+            return LinkedAnswerState(self.market.linked_state(), self.answer_id)
+        return InfoState(self.pool_yes, self.pool_no, self.p, self.market.order_book(self.answer_id))
 
     def __str__(self):
         return f"{self.market.question} ({self.answer_text})"
@@ -321,19 +706,29 @@ class MultiMarketAnswer:
         """
         return post_order_independent_multi(self.market_id, self.answer_id, mana_amount, outcome, limit_prob, expiration_delta=expiration_delta)
 
+    def sell_order(self, shares, outcome):
+        """
+        Sell shares of this answer.
+        """
+        return sell_shares(self.market_id, outcome, shares, answer_id=self.answer_id)
+
 
 class Share:
     """
     A class to represent a share of a market on Manifold.
     """
 
-    def __init__(self, slug, answer_text=None, yes=True):
+    def __init__(self, slug, answer_text=None, yes=True, market=None):
+        """
+        `market` optionally gives an already constructed Market to read this share's market from.
+        """
         self.yes = yes
         self.slug = slug
         if answer_text is None:
-            self.market = Market(slug=slug)
+            self.market = Market(slug=slug) if market is None else market
         else:
-            self.market = MultiMarketAnswer(slug=slug, answer_text=answer_text)
+            self.market = MultiMarketAnswer(
+                slug=slug, answer_text=answer_text, market=market)
         self.answer_text = answer_text
 
     def refresh(self):
@@ -349,13 +744,22 @@ class Share:
     def __repr__(self):
         return str(self)
 
+    @property
+    def key(self):
+        """
+        The identity of the share, known without any API calls.
+
+        Slugs identify markets uniquely, so two shares are the same exactly when their keys are.
+        """
+        return (self.slug, self.answer_text, self.yes)
+
     def __eq__(self, __value: object) -> bool:
         if not isinstance(__value, Share):
             return False
-        return self.market.market_id == __value.market.market_id and self.answer_text == __value.answer_text and self.yes == __value.yes
+        return self.key == __value.key
 
     def __hash__(self) -> int:
-        return hash((self.slug, self.answer_text, self.yes))
+        return hash(self.key)
 
     def __invert__(self):
         return Share(self.slug, answer_text=self.answer_text, yes=not self.yes)
@@ -366,8 +770,30 @@ class Share:
         """
         return self.market.probability if self.yes else 1 - self.market.probability
 
+    def order_fields(self):
+        """
+        The market id, answer id (None for binary markets) and outcome that orders for this share are placed with.
+        """
+        return {"market_id": self.market.market_id,
+                "answer_id": None if self.answer_text is None else self.market.answer_id,
+                "outcome": "YES" if self.yes else "NO"}
+
     def post_order(self, mana_amount, limit_prob, expiration_delta=60*1000):
 
         assert (self.market.isClosed == False)
 
         return self.market.post_order(mana_amount, "YES" if self.yes else "NO", limit_prob, expiration_delta=expiration_delta)
+
+    def cancel_order(self, bet):
+        """
+        Cancel the rest of `bet`, a limit order on this share that only partly filled.
+
+        Returns the bet as it was when cancelled, or None if cancelling failed.
+        """
+        return cancel_bet(bet["betId"])
+
+    def sell(self, shares):
+
+        assert (self.market.isClosed == False)
+
+        return self.market.sell_order(shares, "YES" if self.yes else "NO")
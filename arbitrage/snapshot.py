@@ -0,0 +1,154 @@
+"""
+Immutable, network-free snapshots of portfolios.
+
+A `PortfolioSnapshot` records everything about a portfolio's markets and our holdings in them that an arb decision depends on, as it was at one instant. Unlike a `Portfolio`, whose shares fetch from the API whenever they are asked anything, a snapshot is plain data: it can be pickled, sent to worker processes, hashed, compared and logged.
+"""
+
+from dataclasses import dataclass, fields
+from typing import Optional, Tuple
+
+
+class _SlotsState:
+    """
+    Pickling for frozen dataclasses with `__slots__`, which have no `__dict__` to save and can't be restored by setting their attributes.
+
+    Fields are declared in `__slots__` with no class-level defaults, which would clash with the slots.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, field.name) for field in fields(self))
+
+    def __setstate__(self, state):
+        for field, value in zip(fields(self), state):
+            object.__setattr__(self, field.name, value)
+
+
+@dataclass(frozen=True)
+class OrderBook(_SlotsState):
+    """
+    The open limit orders of a market or multi market answer, aggregated into price levels.
+
+    `yes_levels` are the resting NO orders, which a YES bet fills against: (probability, YES shares available) pairs in increasing probability. A NO order at probability q buys NO shares at 1 - q, so a YES bet pushing the probability past q gets YES shares from it at q each.
+    `no_levels` are the resting YES orders, which a NO bet fills against: (probability, NO shares available) pairs in decreasing probability, whose NO shares cost 1 - q each.
+    """
+    __slots__ = ("yes_levels", "no_levels")
+    yes_levels: Tuple[Tuple[float, float], ...]
+    no_levels: Tuple[Tuple[float, float], ...]
+
+    def __post_init__(self):
+        object.__setattr__(self, "yes_levels", tuple(self.yes_levels))
+        object.__setattr__(self, "no_levels", tuple(self.no_levels))
+
+    @classmethod
+    def from_orders(cls, orders):
+        """
+        Aggregate limit order bets from the API into an OrderBook.
+        """
+        yes_levels = {}
+        no_levels = {}
+        for order in orders:
+            q = order["limitProb"]
+            unfilled = order["orderAmount"] - order.get("amount", 0)
+            if unfilled <= 0:
+                continue
+            if order["outcome"] == "NO":
+                yes_levels[q] = yes_levels.get(q, 0) + unfilled / (1 - q)
+            else:
+                no_levels[q] = no_levels.get(q, 0) + unfilled / q
+        return cls(sorted(yes_levels.items()),
+                   sorted(no_levels.items(), reverse=True))
+
+    def __bool__(self):
+        return len(self.yes_levels) > 0 or len(self.no_levels) > 0
+
+    def levels(self, yes, prob):
+        """
+        The levels a bet on `yes` (or no) at probability `prob` can fill against, as (probability, price per share, shares available) triples from the cheapest.
+        """
+        if yes:
+            return [(q, q, shares) for q, shares in self.yes_levels if q > prob]
+        return [(q, 1 - q, shares) for q, shares in self.no_levels if q < prob]
+
+    def after_fills(self, yes, fills):
+        """
+        The order book left after a bet on `yes` (or no) takes `fills`, a dict from probability to shares, from its levels.
+        """
+        levels = [(q, shares - fills.get(q, 0))
+                  for q, shares in (self.yes_levels if yes else self.no_levels)]
+        levels = [(q, shares) for q, shares in levels if shares > 1e-9]
+        if yes:
+            return OrderBook(levels, self.no_levels)
+        return OrderBook(self.yes_levels, levels)
+
+
+@dataclass(frozen=True)
+class LegSnapshot(_SlotsState):
+    """
+    The state of one share of a portfolio, and of our position in it.
+
+    For an answer of a choose-one multi market, `linked_pools` holds an (answer id, YES pool, NO pool) triple for each of the market's other unresolved answers, which a bet on this answer also trades against. It is empty otherwise.
+
+    `order_book` is the `OrderBook` of open limit orders that a bet fills against before the pool, or None if there are none (or, for choose-one answers, they aren't modelled).
+    """
+    __slots__ = ("slug", "answer_text", "market_id", "answer_id", "yes", "weight",
+                 "pool_yes", "pool_no", "p", "holding", "complimentary_holding",
+                 "linked_pools", "order_book")
+    slug: str
+    answer_text: Optional[str]
+    market_id: str
+    answer_id: Optional[str]
+    yes: bool
+    weight: float
+    pool_yes: float
+    pool_no: float
+    p: float
+    holding: float
+    complimentary_holding: float
+    linked_pools: Tuple[Tuple[str, float, float], ...]
+    order_book: Optional[OrderBook]
+
+    def __post_init__(self):
+        object.__setattr__(self, "linked_pools", tuple(self.linked_pools))
+        # An empty order book is stored as None, so that snapshots with and without one compare equal
+        object.__setattr__(self, "order_book", self.order_book or None)
+
+    @property
+    def key(self):
+        """
+        The identity of the share, the same as `Share.key`.
+        """
+        return (self.slug, self.answer_text, self.yes)
+
+    @property
+    def pool(self):
+        return (self.pool_yes, self.pool_no)
+
+    @property
+    def prob(self):
+        return self.pool_no * self.p / (self.pool_yes * (1 - self.p) + self.pool_no * self.p)
+
+
+@dataclass(frozen=True)
+class PortfolioSnapshot(_SlotsState):
+    """
+    The state of every share in a portfolio at one instant.
+
+    `time` is in milliseconds since the epoch, like the times in the API.
+    """
+    __slots__ = ("legs", "time")
+    legs: Tuple[LegSnapshot, ...]
+    time: int
+
+    def __post_init__(self):
+        object.__setattr__(self, "legs", tuple(self.legs))
+
+    @property
+    def key(self):
+        """
+        The identity of the portfolio, independent of market state.
+        """
+        return tuple(leg.key for leg in self.legs)
+
+    def __len__(self):
+        return len(self.legs)
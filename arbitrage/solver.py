@@ -0,0 +1,71 @@
+"""
+Solver selection for the convex programs used to plan arbs.
+
+Solvers are tried in order of preference, and a solver that raises or does not report an optimal solution is recorded and skipped in favour of the next one.
+"""
+
+import logging
+import time
+from collections import deque, namedtuple
+import cvxpy as cp
+import metrics
+
+# Fastest first. Our problems are tiny second order cone programs, for which the interior point solvers are both quicker and more precise than SCS.
+SOLVER_PREFERENCE = [cp.CLARABEL, cp.ECOS, cp.SCS]
+
+# SCS at its default tolerances gives answers that are off by whole mana, so tighten it when we do fall back to it.
+SOLVER_OPTIONS = {
+    cp.SCS: {"eps_abs": 1e-9, "eps_rel": 1e-9, "max_iters": 100000},
+}
+
+SolverFailure = namedtuple("SolverFailure", ["time", "solver", "reason"])
+
+# The most recent solver failures, newest last
+solver_failures = deque(maxlen=100)
+
+
+def available_solvers(preference=None):
+    """
+    Return the solvers from `preference` (default SOLVER_PREFERENCE) that are installed, in order.
+    """
+    if preference is None:
+        preference = SOLVER_PREFERENCE
+    installed = cp.installed_solvers()
+    return [solver for solver in preference if solver in installed]
+
+
+def solve(problem, preference=None, warm_start=False):
+    """
+    Solve `problem` with the first solver that reports it optimal.
+
+    Returns the name of the solver that succeeded. Raises ValueError if none did.
+    """
+    solvers = available_solvers(preference)
+    if len(solvers) == 0:
+        raise ValueError("None of the preferred solvers are installed")
+
+    for solver in solvers:
+        try:
+            with metrics.timer("solver_seconds", solver=solver):
+                problem.solve(solver=solver, warm_start=warm_start,
+                              **SOLVER_OPTIONS.get(solver, {}))
+        except cp.error.SolverError as error:
+            record_failure(solver, str(error))
+            continue
+
+        if problem.status == cp.OPTIMAL:
+            return solver
+
+        record_failure(solver, f"Problem status is {problem.status}")
+
+    raise ValueError(
+        f"No solver succeeded, last problem status is {problem.status}")
+
+
+def record_failure(solver, reason):
+    """
+    Record that `solver` failed for `reason`.
+    """
+    logging.warning(f"Solver {solver} failed: {reason}")
+    metrics.increment("solver_failures", solver=solver)
+    solver_failures.append(SolverFailure(time.time(), solver, reason))
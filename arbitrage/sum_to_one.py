@@ -0,0 +1,86 @@
+"""
+Find arbs within single multi markets, whose answers' probabilities should sum to one but don't.
+
+If exactly one answer of a market will resolve YES, then buying a YES share of every answer is worth exactly 1, and buying a NO share of every answer is worth exactly (number of answers - 1). If the YES (or NO) shares can be bought for less, that is an arb.
+
+Choose-one (linked) multi markets are kept summing to one by Manifold itself, so this is for independent multi markets whose answers we know to be mutually exclusive and exhaustive.
+"""
+
+import numpy as np
+from shares import Share
+from portfolio import Portfolio
+from planning import DEFAULT_API_FEE_PER_TRADE
+
+# The numbers of shares of each answer that baskets are priced at
+BASKET_SIZES = np.geomspace(1, 1000, 16)
+
+
+def basket_costs(pool_received, pool_other, sizes):
+    """
+    The mana needed to buy each of `sizes` shares from each of a batch of p = 0.5 pools.
+
+    `pool_received` is the side of each pool the shares come out of. Returns an array of shape (pools, sizes).
+    """
+    pool_received = pool_received[:, None]
+    pool_other = pool_other[:, None]
+    # Solve the pool invariant (received + cost - shares) * (other + cost) = received * other for cost, as in InfoState.amount_for_shares
+    b = pool_received + pool_other - sizes[None, :]
+    return (-b + np.sqrt(b ** 2 + 4 * sizes[None, :] * pool_other)) / 2
+
+
+def scan_for_sum_to_one_arbs(markets, api_fee_per_trade=DEFAULT_API_FEE_PER_TRADE):
+    """
+    Price the YES-all and NO-all baskets of every market in `markets` at once.
+
+    `markets` are `Market`s of independent multi markets with mutually exclusive and exhaustive answers. Markets with an answer that has resolved YES are skipped, and the baskets of the rest are made of their unresolved answers.
+
+    Returns a list of (portfolio, true value, estimated profit) for each basket that is profitable at some size.
+    """
+    # Gather the unresolved answers of all the markets into flat arrays
+    usable_markets = []
+    answers = []
+    for market in markets:
+        if market.isResolved or market.isLinked:
+            continue
+        # Once an answer has resolved YES, every other answer resolves NO, so neither basket is worth what it is priced at below
+        if any(answer.get("resolution") == "YES" for answer in market.data["answers"]):
+            continue
+        unresolved = [answer for answer in market.data["answers"]
+                      if answer.get("resolution") is None]
+        if len(unresolved) < 2:
+            continue
+        usable_markets.append(market)
+        answers.append(unresolved)
+
+    if len(usable_markets) == 0:
+        return []
+
+    counts = np.array([len(market_answers) for market_answers in answers])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    pool_yes = np.array([answer["pool"]["YES"]
+                        for market_answers in answers for answer in market_answers], dtype=float)
+    pool_no = np.array([answer["pool"]["NO"]
+                       for market_answers in answers for answer in market_answers], dtype=float)
+
+    # The cost of each basket size, summed over the answers of each market
+    yes_costs = np.add.reduceat(basket_costs(
+        pool_yes, pool_no, BASKET_SIZES), starts, axis=0)
+    no_costs = np.add.reduceat(basket_costs(
+        pool_no, pool_yes, BASKET_SIZES), starts, axis=0)
+
+    fees = (api_fee_per_trade * counts)[:, None]
+    yes_profits = BASKET_SIZES[None, :] - yes_costs - fees
+    no_profits = BASKET_SIZES[None, :] * \
+        (counts - 1)[:, None] - no_costs - fees
+
+    arbs = []
+    for i in np.flatnonzero(yes_profits.max(axis=1) > 0):
+        shares = [Share(usable_markets[i].slug, answer_text=answer["text"], market=usable_markets[i])
+                  for answer in answers[i]]
+        arbs.append((Portfolio(shares), 1, yes_profits[i].max()))
+    for i in np.flatnonzero(no_profits.max(axis=1) > 0):
+        shares = [Share(usable_markets[i].slug, answer_text=answer["text"], yes=False, market=usable_markets[i])
+                  for answer in answers[i]]
+        arbs.append((Portfolio(shares), counts[i] - 1, no_profits[i].max()))
+
+    return arbs
@@ -0,0 +1,164 @@
+"""
+Mutual information of joint markets over time, for any number of markets at once.
+
+A joint market is a multi market with an answer for each combination of the outcomes of two questions, so its answer probabilities form an n by m matrix at each time.
+The scoring stage fetches the markets' bets, builds their probability tensors on one shared time grid, and computes the mutual information time series and time-weighted averages of every market together.
+Plotting is a separate stage, run only if wanted.
+"""
+
+import os
+import sys
+from collections import namedtuple
+import numpy as np
+import scipy.stats
+
+SCORING_WORKERS = 8
+
+# A joint market, with answer_ids an n by m nested list of the id of the answer for each pair of outcomes
+JointMarket = namedtuple("JointMarket", ["slug", "answer_ids"])
+
+# The probability tensors and mutual information of some joint markets
+# times has the time grid of each market, probabilities has one n by m by len(times) array per market, and mutual_information and averages have one series or value per market
+Scores = namedtuple(
+    "Scores", ["markets", "times", "probabilities", "mutual_information", "averages"])
+
+
+def mutual_information(probabilities):
+    # Takes an n by m by ... array of joint probabilities and computes the mutual information along the first two axes
+    # Each n by m slice is normalized separately, so the probabilities need not sum to exactly 1
+    probabilities = np.asarray(probabilities, dtype=float)
+    n, m = probabilities.shape[:2]
+
+    # Compute the marginal probabilities
+    row_probabilities = probabilities.sum(axis=1)
+    column_probabilities = probabilities.sum(axis=0)
+
+    # Compute the entropy of the rows, columns and the whole matrix, which scipy normalizes
+    row_entropy = scipy.stats.entropy(row_probabilities, axis=0)
+    column_entropy = scipy.stats.entropy(column_probabilities, axis=0)
+    matrix_entropy = scipy.stats.entropy(np.reshape(
+        probabilities, (n * m,) + probabilities.shape[2:]), axis=0)
+
+    return row_entropy + column_entropy - matrix_entropy
+
+
+def get_price_series(bets):
+    # Return a dict from answer id to (times, prices after, price before the first bet), with times and prices arrays sorted by time
+    series = {}
+    for answer_id in set(bet["answerId"] for bet in bets):
+        answer_bets = sorted((bet for bet in bets if bet["answerId"] == answer_id),
+                             key=lambda bet: bet["createdTime"])
+        series[answer_id] = (
+            np.array([bet["createdTime"] for bet in answer_bets]),
+            np.array([bet["probAfter"] for bet in answer_bets], dtype=float),
+            answer_bets[0].get("probBefore", 0.5),
+        )
+    return series
+
+
+def get_price_at_time(t, answer_id, price_series, as_of=False):
+    # Get the price at a given time, or an array of times
+    # By default, return the price after the first bet at or after each time, or 0.5 if there is none
+    # With as_of, return the price after the last bet at or before each time, or before the first bet if there is none, which doesn't depend on what other times are asked for
+    t = np.asarray(t)
+    if answer_id not in price_series:
+        return np.full(t.shape, 0.5)
+    answer_times, answer_prices, first_price = price_series[answer_id]
+    if as_of:
+        indices = np.searchsorted(answer_times, t, side="right") - 1
+        return np.where(indices >= 0, answer_prices[np.maximum(indices, 0)], first_price)
+    # Binary search for the index of the first time not before each time
+    indices = np.searchsorted(answer_times, t, side="left")
+    found = indices < len(answer_times)
+    return np.where(found, answer_prices[np.minimum(indices, len(answer_times) - 1)], 0.5)
+
+
+def time_grid(bets_of_markets, start_time, end_time):
+    # The times of every bet strictly between start_time and end_time, with start_time and end_time themselves
+    times = np.unique(np.concatenate(
+        [[bet["createdTime"] for bet in bets] for bets in bets_of_markets] + [[]]))
+    times = times[(start_time < times) & (times < end_time)]
+    return np.concatenate([[start_time], times, [end_time]])
+
+
+def time_weighted_average(values, times):
+    # Average values along their last axis, weighting each by how long it holds until the next time
+    return np.average(values[..., :-1], weights=np.diff(times), axis=-1)
+
+
+def score(markets, start_time, end_time, bet_store=None, as_of=True, max_workers=SCORING_WORKERS):
+    """
+    Compute the mutual information time series of each of `markets` (`JointMarket`s) between start_time and end_time (milliseconds), and its time-weighted average.
+
+    With as_of, all the markets share one time grid of every bet time. Use as_of=False for the prices at the first bet at or after each time, as judging.py does; as this depends on the grid, each market then has the grid of its own bets.
+    """
+    if bet_store is None:
+        # Bets are kept in the arbitrage bot's bet store, so only new bets are fetched on each run
+        # It is imported here so that the rest of this module works without the bot's dependencies
+        sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "..", "arbitrage"))
+        from bet_store import BetStore
+        bet_store = BetStore()
+    bet_store.sync([{"contract_slug": market.slug} for market in markets],
+                   max_workers=max_workers)
+    bets_of_markets = [bet_store.bets(contract_slug=market.slug)
+                       for market in markets]
+
+    if as_of:
+        grids = [time_grid(bets_of_markets, start_time, end_time)] * len(markets)
+    else:
+        grids = [time_grid([bets], start_time, end_time)
+                 for bets in bets_of_markets]
+    probabilities = []
+    for market, bets, times in zip(markets, bets_of_markets, grids):
+        price_series = get_price_series(bets)
+        probabilities.append(np.array([[get_price_at_time(times, answer_id, price_series, as_of=as_of)
+                                         for answer_id in row] for row in market.answer_ids]))
+
+    # Stack markets with the same grid and shape of matrix and compute the mutual information of each stack in one pass
+    mi = [None] * len(markets)
+    groups = {}
+    for i, market_probabilities in enumerate(probabilities):
+        groups.setdefault((id(grids[i]), market_probabilities.shape), []).append(i)
+    for indices in groups.values():
+        stacked = np.stack([probabilities[i] for i in indices], axis=2)
+        for i, market_mi in zip(indices, mutual_information(stacked)):
+            mi[i] = market_mi
+
+    averages = np.array([time_weighted_average(market_mi, times)
+                         for market_mi, times in zip(mi, grids)])
+    return Scores(markets, grids, probabilities, mi, averages)
+
+
+def plot(scores, directory="img", y_max=0.15, time_labels=None):
+    # Plot the probabilities and mutual information over time of each market in scores, one file per market
+    # time_labels is an optional dict from time to the label of a tick at that time
+    import matplotlib.pyplot as plt
+
+    for market, times, probabilities, mi, mi_average in zip(scores.markets, scores.times, scores.probabilities,
+                                                            scores.mutual_information, scores.averages):
+        # Pyplot make two adjacent figures
+        fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True, figsize=(10, 10))
+        fig.suptitle(f"Data for {market.slug}")
+
+        # Plot the probabilities over time on the top
+        ax1.set_title("Probabilities")
+        ax1.set_ylabel("Probability")
+        for i, row in enumerate(market.answer_ids):
+            for j in range(len(row)):
+                ax1.step(times, probabilities[i, j, :],
+                         label=f"{i}, {j}", where="post")
+
+        # Plot the mutual information over time on the bottom
+        ax2.set_title("Mutual Information")
+        ax2.set_xlabel("Time")
+        if time_labels is not None:
+            ax2.set_xticks(list(time_labels), labels=list(time_labels.values()))
+        ax2.set_ylabel("Mutual Information")
+        ax2.set_ylim(0, y_max)
+        ax2.step(times, mi, label="Mutual Information", where="post")
+        #  make a dashed horizontal line at mi_average
+        ax2.axhline(mi_average, color='grey', label="Avg MI", linestyle='--')
+        plt.legend()
+        plt.savefig(os.path.join(directory, f"{market.slug}_mi.png"))
+        plt.close(fig)